@@ -0,0 +1,22 @@
+""" Benchmarks for repoze.bitblt.
+
+Run them from the source checkout with ``python -m benchmarks.run``;
+see ``benchmarks/run.py`` for the options. Every suite is a module with
+a ``run(quick=False)`` function which returns a list of results as made
+by ``measure``."""
+
+import time
+
+def measure(name, fn, repeat=5, number=1, **params):
+    """Call ``fn`` ``number`` times in each of ``repeat`` rounds and
+    return the timings of the fastest round as a dictionary."""
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        for j in range(number):
+            fn()
+        timings.append((time.time() - start) / number)
+    best = min(timings)
+    return dict(name=name, params=params, repeat=repeat, number=number,
+                best=best, mean=sum(timings) / len(timings),
+                per_second=best and 1 / best or None)
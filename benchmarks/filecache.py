@@ -0,0 +1,72 @@
+""" Benchmark lookups in a ``file`` cache holding many entries, with
+all files in one directory and spread over subdirectories.
+
+  python -m benchmarks.filecache [ENTRIES [DIRECTORY]]
+
+Filling the cache takes a while for a million entries; the directory
+should be on the file system the cache is going to live on."""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from repoze.bitblt.cache import FileSystemCache
+from repoze.bitblt.cache import makedirs
+
+from benchmarks import measure
+
+levels = (0, 2)
+
+def fill(cache, entries, value='x' * 1024):
+    """Write ``entries`` files directly, bypassing the atomic writes
+    of the cache, which is what takes the time."""
+    for i in xrange(entries):
+        path = cache.path('entry-%d' % i)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        except OSError:
+            makedirs(os.path.dirname(path))
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        os.write(fd, value)
+        os.close(fd)
+
+def run(quick=False, entries=None, directory=None, lookups=2000):
+    if entries is None:
+        entries = quick and 10000 or 1000000
+    results = []
+    for level in levels:
+        temp_dir = tempfile.mkdtemp(prefix='bitblt-filecache-',
+                                    dir=directory)
+        try:
+            cache = FileSystemCache(temp_dir, levels=level)
+            fill(cache, entries)
+            keys = ['entry-%d' % random.randrange(entries)
+                    for i in range(lookups)]
+            missing = ['missing-%d' % i for i in range(lookups)]
+            def hits():
+                for key in keys:
+                    cache.get(key)
+            def misses():
+                for key in missing:
+                    cache.get(key)
+            for name, fn in (('hit', hits), ('miss', misses)):
+                result = measure('filecache', fn, repeat=quick and 1 or 3,
+                                 levels=level, entries=entries, lookup=name)
+                # per lookup
+                for timing in ('best', 'mean'):
+                    result[timing] /= lookups
+                result['per_second'] = 1 / result['best']
+                results.append(result)
+        finally:
+            shutil.rmtree(temp_dir)
+    return results
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    results = run(entries=args and int(args[0]) or None,
+                  directory=args[1:] and args[1] or None)
+    for result in results:
+        print('levels=%(levels)d %(lookup)s: %(best_us).1f us' % dict(
+            result['params'], best_us=result['best'] * 1e6))
@@ -0,0 +1,45 @@
+""" Generated fixtures, so that the benchmarks run offline."""
+
+from cStringIO import StringIO
+
+try:
+    from PIL import Image
+    from PIL import ImageDraw
+except ImportError:
+    import Image
+    import ImageDraw
+
+def image_data(format, size):
+    """Return an image in ``format`` (``JPEG``, ``PNG`` or ``GIF``) of
+    ``size`` with some gradients and shapes to compress."""
+    width, height = size
+    image = Image.new('RGB', size)
+    draw = ImageDraw.Draw(image)
+    for x in range(0, width, 4):
+        draw.line([(x, 0), (x, height)],
+                  fill=(x * 255 // width, 128, 255 - x * 255 // width))
+    for i in range(0, min(size), max(min(size) // 8, 1)):
+        draw.ellipse([i, i, width - i, height - i], outline=(255, i % 256, 0))
+    if format == 'GIF':
+        image = image.convert('P', palette=Image.ADAPTIVE)
+    out = StringIO()
+    image.save(out, format)
+    return out.getvalue()
+
+def html_page(blocks, density=0.5, sizes=8):
+    """Return a document with ``blocks`` paragraphs and image tags, the
+    share ``density`` of which are image tags in one of ``sizes``
+    sizes."""
+    parts = [u'<!DOCTYPE html>\n<html><head><title>Catalogue</title>'
+             u'</head><body>']
+    for i in range(blocks):
+        if int((i + 1) * density) > int(i * density):
+            size = 80 + 20 * (i % sizes)
+            parts.append(u'<img src="/images/%d.jpg" width="%d" height="%d" '
+                         u'alt="Image %d" />' % (i, size, size * 3 // 4, i))
+        else:
+            parts.append(u'<p class="text">Lorem ipsum dolor sit amet, '
+                         u'consectetur adipiscing elit, sed do eiusmod '
+                         u'tempor.</p>')
+    parts.append(u'</body></html>')
+    return u'\n'.join(parts)
@@ -0,0 +1,47 @@
+""" Benchmark ``ImageTransformationMiddleware.process`` across formats,
+source sizes and filters, and ``process_many`` against scaling to
+several sizes one by one."""
+
+from cStringIO import StringIO
+
+from repoze.bitblt.processor import ImageTransformationMiddleware
+
+from benchmarks import fixtures
+from benchmarks import measure
+
+formats = ('JPEG', 'PNG', 'GIF')
+sources = ((640, 480), (1600, 1200), (4000, 3000))
+filters = ('nearest', 'bilinear', 'bicubic', 'antialias')
+size = (200, 150)
+batch_sizes = [(800, 600), (400, 300), (200, 150), (100, 75)]
+
+def run(quick=False):
+    results = []
+    for format in formats:
+        for source in quick and sources[:1] or sources:
+            data = fixtures.image_data(format, source)
+            for filter in quick and filters[-1:] or filters:
+                middleware = ImageTransformationMiddleware(
+                    None, secret='secret', filter=filter)
+                def process():
+                    middleware.process(StringIO(data), size)
+                results.append(measure(
+                    'process', process, repeat=quick and 1 or 5,
+                    format=format, source='%dx%d' % source, filter=filter,
+                    size='%dx%d' % size, source_bytes=len(data)))
+
+    middleware = ImageTransformationMiddleware(None, secret='secret')
+    for format in formats:
+        data = fixtures.image_data(format, sources[-1])
+        def separately():
+            for size in batch_sizes:
+                middleware.process(StringIO(data), size)
+        def batch():
+            middleware.process_many(StringIO(data), batch_sizes)
+        for name, fn in (('process.separate', separately),
+                         ('process.batch', batch)):
+            results.append(measure(
+                name, fn, repeat=quick and 1 or 5, format=format,
+                source='%dx%d' % sources[-1], sizes=len(batch_sizes),
+                source_bytes=len(data)))
+    return results
@@ -0,0 +1,50 @@
+""" Benchmark the encoder profiles: the time to scale an image with
+each profile and the size of the result, to weigh CPU against
+bandwidth."""
+
+from cStringIO import StringIO
+
+from repoze.bitblt.processor import ImageTransformationMiddleware
+
+from benchmarks import fixtures
+from benchmarks import measure
+
+source = (1600, 1200)
+size = (400, 300)
+profiles = (
+    ('JPEG', 'default', {}),
+    ('JPEG', 'optimize', dict(jpeg_optimize='true')),
+    ('JPEG', 'progressive', dict(jpeg_progressive='true')),
+    ('JPEG', 'optimize+progressive',
+     dict(jpeg_optimize='true', jpeg_progressive='true')),
+    ('JPEG', '4:4:4', dict(jpeg_subsampling='4:4:4')),
+    ('JPEG', '4:2:0', dict(jpeg_subsampling='4:2:0')),
+    ('PNG', 'default', {}),
+    ('PNG', 'compress_level=1', dict(png_compress_level='1')),
+    ('PNG', 'compress_level=9', dict(png_compress_level='9')),
+    ('PNG', 'optimize', dict(png_optimize='true')),
+    ('PNG', 'quantize=256', dict(png_quantize='256')),
+    ('PNG', 'quantize=64', dict(png_quantize='64')),
+    ('GIF', 'preserve', {}),
+    ('GIF', 'adaptive', dict(gif_palette='adaptive')),
+    )
+
+def run(quick=False):
+    results = []
+    sources = {}
+    for format, name, options in profiles:
+        if quick and name != 'default' and format != 'GIF':
+            continue
+        if format not in sources:
+            sources[format] = fixtures.image_data(format, source)
+        data = sources[format]
+        middleware = ImageTransformationMiddleware(
+            None, secret='secret', **options)
+        def process():
+            return middleware.process(StringIO(data), size)
+        result = measure(
+            'profile', process, repeat=quick and 1 or 5, format=format,
+            profile=name, source='%dx%d' % source, size='%dx%d' % size,
+            source_bytes=len(data), bytes=len(process()))
+        results.append(result)
+    return results
@@ -0,0 +1,54 @@
+""" Benchmark ``rewrite_image_tags`` on documents of varying size and
+image tag density, ``re_img`` against ``re_img_short``, which
+``rewrite_image_tags`` uses, on the same documents, and ``re_img``
+against ``iter_image_tags`` on tags which don't match."""
+
+from repoze.bitblt.transform import iter_image_tags
+from repoze.bitblt.transform import re_img
+from repoze.bitblt.transform import re_img_short
+from repoze.bitblt.transform import rewrite_image_tags
+from repoze.bitblt.transform import SignatureCache
+
+from benchmarks import fixtures
+from benchmarks import measure
+
+blocks = (100, 1000, 10000)
+densities = (0, 0.1, 0.5, 1)
+# re_img takes exponential time in the number of attributes of tags
+# which don't match, so keep these small
+attributes = (4, 8, 12)
+
+scanners = (('re_img', re_img.finditer),
+            ('re_img_short', re_img_short.finditer))
+unmatched_scanners = (('re_img', re_img.finditer),
+                      ('iter_image_tags', iter_image_tags))
+
+def scan(scanner, body):
+    for match in scanner(body):
+        pass
+
+def run(quick=False):
+    results = []
+    signatures = SignatureCache('secret')
+    for count in quick and blocks[:2] or blocks:
+        for density in densities:
+            body = fixtures.html_page(count, density)
+            def rewrite():
+                rewrite_image_tags(body, 'secret', signatures=signatures)
+            results.append(measure(
+                'rewrite_image_tags', rewrite, repeat=quick and 1 or 5,
+                number=max(10000 // count, 1), blocks=count,
+                density=density, length=len(body)))
+            for name, scanner in scanners:
+                results.append(measure(
+                    'scan.%s' % name, lambda: scan(scanner, body),
+                    repeat=quick and 1 or 5, number=max(10000 // count, 1),
+                    blocks=count, density=density, length=len(body)))
+    for count in quick and attributes[:2] or attributes:
+        body = '<img%s data-x=1 <p>' % (' src=a width=1' * (count // 2))
+        for name, scanner in unmatched_scanners:
+            results.append(measure(
+                'scan_unmatched.%s' % name, lambda: scan(scanner, body),
+                repeat=quick and 1 or 3, number=1, attributes=count,
+                length=len(body)))
+    return results
@@ -0,0 +1,57 @@
+""" Run the benchmarks and write the results as JSON.
+
+  python -m benchmarks.run [--quick] [--suite NAME ...] [--output FILE]
+"""
+
+import json
+import optparse
+import platform
+import sys
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+suites = ('process', 'profiles', 'rewrite', 'signatures', 'wsgi',
+          'filecache')
+
+def environment():
+    return dict(
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        platform=platform.platform(),
+        pil=getattr(Image, '__version__', getattr(Image, 'VERSION', None)),
+        time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option(
+        '-s', '--suite', action='append', dest='suites', choices=suites,
+        help='run only this suite (%s); may be repeated' % ', '.join(suites))
+    parser.add_option(
+        '-q', '--quick', action='store_true', default=False,
+        help='run fewer variants, once each, e.g. as a smoke test')
+    parser.add_option(
+        '-o', '--output', help='write the results to this file')
+    options, args = parser.parse_args(argv)
+
+    results = {}
+    for name in options.suites or suites:
+        module = __import__('benchmarks.%s' % name, fromlist=['run'])
+        sys.stderr.write('%s...\n' % name)
+        results[name] = module.run(quick=options.quick)
+    report = dict(environment=environment(), quick=options.quick,
+                  results=results)
+
+    output = options.output and open(options.output, 'w') or sys.stdout
+    try:
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == '__main__':
+    main()
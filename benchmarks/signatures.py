@@ -0,0 +1,20 @@
+""" Benchmark signature memoization on a catalogue page with 2000
+thumbnails in a few dozen sizes."""
+
+from repoze.bitblt import transform
+
+from benchmarks import fixtures
+from benchmarks import measure
+
+def run(quick=False):
+    body = fixtures.html_page(2000, density=1, sizes=24)
+    signatures = transform.SignatureCache('secret')
+    def uncached():
+        transform.rewrite_image_tags(
+            body, 'secret', signatures=lambda width, height:
+            transform.compute_signature(width, height, 'secret'))
+    def cached():
+        transform.rewrite_image_tags(body, 'secret', signatures=signatures)
+    repeat = quick and 1 or 5
+    return [measure('signatures', uncached, repeat=repeat, memoized=False),
+            measure('signatures', cached, repeat=repeat, memoized=True)]
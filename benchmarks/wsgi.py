@@ -0,0 +1,67 @@
+""" Benchmark full WSGI round trips through the middleware, with and
+without a cache."""
+
+import shutil
+import tempfile
+
+import webob
+
+from repoze.bitblt.processor import ImageTransformationMiddleware
+from repoze.bitblt.transform import compute_signature
+
+from benchmarks import fixtures
+from benchmarks import measure
+
+def make_app():
+    """Return an application serving a catalogue page and the images
+    on it."""
+    page = fixtures.html_page(200, density=0.5).encode('utf-8')
+    image = fixtures.image_data('JPEG', (1600, 1200))
+    def app(environ, start_response):
+        if environ['PATH_INFO'].startswith('/images/'):
+            response = webob.Response(image, content_type='image/jpeg')
+        else:
+            response = webob.Response(page, content_type='text/html')
+        return response(environ, start_response)
+    return app
+
+def image_path(index, width=200, height=150):
+    signature = compute_signature(str(width), str(height), 'secret')
+    return '/images/bitblt-%dx%d-%s/%d.jpg' % (
+        width, height, signature, index)
+
+def get(middleware, path):
+    response = webob.Request.blank(path).get_response(middleware)
+    assert response.status_int == 200, response.status
+    return response.body
+
+def run(quick=False):
+    results = []
+    repeat = quick and 1 or 5
+    directory = tempfile.mkdtemp()
+    try:
+        configurations = (
+            ('none', {}),
+            ('memory', dict(cache='bitblt', cache_backend='memory')),
+            ('file', dict(cache=directory)),
+            )
+        for cache, options in configurations:
+            middleware = ImageTransformationMiddleware(
+                make_app(), secret='secret', **options)
+            results.append(measure(
+                'wsgi', lambda: get(middleware, '/index.html'),
+                repeat=repeat, number=10, cache=cache, request='html'))
+            # the same image over and over again; served from the cache
+            # if there is one
+            get(middleware, image_path(0))
+            results.append(measure(
+                'wsgi', lambda: get(middleware, image_path(0)),
+                repeat=repeat, number=10, cache=cache, request='image'))
+            # a new image every time, so that every request is a miss
+            paths = iter(image_path(i) for i in xrange(1, 1000000))
+            results.append(measure(
+                'wsgi', lambda: get(middleware, paths.next()),
+                repeat=repeat, cache=cache, request='image-miss'))
+    finally:
+        shutil.rmtree(directory)
+    return results
@@ -0,0 +1,693 @@
+""" Cache backends for transformed images.
+
+A backend maps string keys to string values and provides ``get``,
+``set``, ``delete`` and ``stats``. The middleware stores serialized
+cache entries (see ``dump_entry``) in the backend.
+"""
+
+from binascii import crc32
+import heapq
+import os
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+from concurrency import fcntl
+from concurrency import FileLock
+
+CACHE_MAGIC = 'repoze.bitblt/1'
+
+def makedirs(path):
+    """Create the directory ``path`` and its parents, unless another
+    thread or process gets there first."""
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+def dump_entry(headers, body):
+    """Serialize a list of headers and a body into a cache entry. The
+    first line holds the length and CRC32 checksum of the remainder so
+    that truncated or otherwise corrupt entries can be detected."""
+    lines = ['%s: %s' % (name, value) for name, value in headers]
+    data = '\r\n'.join(lines) + '\r\n\r\n' + body
+    return '%s %d %08x\r\n%s' % (
+        CACHE_MAGIC, len(data), crc32(data) & 0xffffffff, data)
+
+def load_entry(data):
+    """Return a ``(headers, body)`` tuple for a cache entry or
+    ``None`` if the data is not a valid entry (e.g. a bare image
+    written by an older version or a truncated file)."""
+    magic, sep, data = data.partition('\r\n')
+    try:
+        magic, length, checksum = magic.split(' ')
+        length, checksum = int(length), int(checksum, 16)
+    except ValueError:
+        return None
+    if magic != CACHE_MAGIC or length != len(data) or \
+           checksum != crc32(data) & 0xffffffff:
+        return None
+    head, sep, body = data.partition('\r\n\r\n')
+    headers = []
+    for line in head.split('\r\n'):
+        if not line:
+            continue
+        name, sep, value = line.partition(': ')
+        if not sep:
+            return None
+        headers.append((name, value))
+    return headers, body
+
+class CacheBackend(object):
+    """Base class for cache backends; subclasses implement ``get``,
+    ``set`` and ``delete`` and count their work in ``counters``. They
+    may implement ``has`` more cheaply than by reading the entry.
+    ``options`` names the keyword arguments which may be configured
+    through ``make_cache``."""
+
+    options = ()
+
+    def __init__(self):
+        self.counters = dict(hits=0, misses=0, sets=0, deletes=0,
+                             evictions=0, errors=0)
+
+    def get(self, key):
+        """Return the value stored for ``key`` or ``None``."""
+        raise NotImplementedError
+
+    def has(self, key):
+        """Return whether a value is stored for ``key``."""
+        return self.get(key) is not None
+
+    def set(self, key, value):
+        """Store ``value`` for ``key``."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove ``key`` from the cache, if present."""
+        raise NotImplementedError
+
+    def stats(self):
+        """Return a dictionary of counters."""
+        return dict(self.counters)
+
+class Index(object):
+    """Bookkeeping for a cache bounded by ``max_entries`` entries
+    and/or ``max_bytes`` bytes.
+
+    Entries are ranked by their last access time (``lru``) or by their
+    number of hits and then last access time (``lfu``). Each access
+    pushes the new rank onto a heap; stale heap items are discarded
+    when popped and the heap is rebuilt once it has grown to twice
+    the number of entries, so ranking costs ``O(log n)`` per access.
+    """
+
+    low_water = 0.9
+
+    def __init__(self, max_entries=None, max_bytes=None, policy='lru'):
+        self.max_entries = max_entries and int(max_entries) or None
+        self.max_bytes = max_bytes and int(max_bytes) or None
+        policy = (policy or 'lru').strip().lower()
+        if policy not in ('lru', 'lfu'):
+            raise ValueError("Unknown eviction policy: %r." % policy)
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.clock = 0
+        self.reset()
+
+    def reset(self, entries=(), since=None):
+        """Replace the index with ``(key, size, atime)`` tuples. Entries
+        which were added or used at or after the time ``since`` are
+        kept as they are."""
+        self.lock.acquire()
+        try:
+            kept = []
+            if since is not None:
+                kept = [(key, entry) for key, entry in self.entries.items()
+                        if entry[1] >= since]
+            self.entries = {}
+            self.heap = []
+            self.size = 0
+            for key, size, atime in entries:
+                self._add(key, size, atime, 0)
+            for key, entry in kept:
+                self._add(key, *entry)
+            self.heap.sort()
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _rank(self, entry):
+        if self.policy == 'lfu':
+            return (entry[2], entry[1])
+        return entry[1]
+
+    def _add(self, key, size, atime, hits):
+        self._remove(key)
+        entry = self.entries[key] = [size, atime, hits]
+        self.size += size
+        self.heap.append((self._rank(entry), key))
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[0]
+        return entry
+
+    def _now(self):
+        # access times must be unique for a strict recency order
+        self.clock = max(time.time(), self.clock + 1e-6)
+        return self.clock
+
+    def _push(self, key, entry):
+        heapq.heappush(self.heap, (self._rank(entry), key))
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [(self._rank(entry), key)
+                         for key, entry in self.entries.items()]
+            heapq.heapify(self.heap)
+
+    def add(self, key, size):
+        self.lock.acquire()
+        try:
+            self._remove(key)
+            entry = self.entries[key] = [size, self._now(), 0]
+            self.size += size
+            self._push(key, entry)
+        finally:
+            self.lock.release()
+
+    def touch(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[1] = self._now()
+                entry[2] += 1
+                self._push(key, entry)
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        self.lock.acquire()
+        try:
+            return self._remove(key) is not None
+        finally:
+            self.lock.release()
+
+    def over(self, ratio=1.0):
+        if self.max_entries is not None and \
+               len(self.entries) > self.max_entries * ratio:
+            return True
+        if self.max_bytes is not None and \
+               self.size > self.max_bytes * ratio:
+            return True
+        return False
+
+    def victims(self, limit=None):
+        """Remove and return up to ``limit`` of the lowest ranked keys
+        once the budget is exceeded, until the index is down to 90% of
+        its budget."""
+        victims = []
+        self.lock.acquire()
+        try:
+            if not self.over():
+                return victims
+            while self.heap and self.over(self.low_water):
+                if limit is not None and len(victims) >= limit:
+                    break
+                rank, key = heapq.heappop(self.heap)
+                entry = self.entries.get(key)
+                if entry is None or self._rank(entry) != rank:
+                    continue
+                self._remove(key)
+                victims.append(key)
+        finally:
+            self.lock.release()
+        return victims
+
+class FileSystemCache(CacheBackend):
+    """Store each entry as a file below ``directory``.
+
+    Files are spread over ``levels`` levels of subdirectories with 256
+    subdirectories each, named after the SHA-1 digest of the file name,
+    so that no directory grows too large. The file name is the key, or
+    a digest of it if the key is too long for a file name.
+
+    Entries are written to a temporary file which is then renamed into
+    place, so that readers never see a partially written file, even
+    while other processes write the same entry. Lock files are removed
+    when they are released. Temporary and lock files (whose names start
+    with a dot) left behind by processes which died are removed when
+    the directory is scanned if they have not been used for
+    ``temp_max_age`` seconds.
+
+    If ``max_entries`` or ``max_bytes`` is set, the cache keeps an
+    index of its files, built by scanning the directory on first use
+    and again every ``rescan_interval`` seconds to pick up files
+    written by other processes. These scans run in a background
+    thread, one at a time; until the first one is done, only the
+    entries written or read since are known to the index. Each write
+    then evicts at most ``compact_batch`` files, so that compaction is
+    spread over many requests instead of stalling one."""
+
+    options = ('max_entries', 'max_bytes', 'eviction', 'rescan_interval',
+               'levels')
+    compact_batch = 32
+    temp_prefix = '.tmp-'
+    lock_prefix = '.lock-'
+    temp_max_age = 3600
+    max_name = 200
+
+    def __init__(self, directory, max_entries=None, max_bytes=None,
+                 eviction='lru', rescan_interval=3600, levels=2):
+        CacheBackend.__init__(self)
+        self.directory = directory
+        self.levels = int(levels)
+        if max_entries or max_bytes:
+            self.index = Index(max_entries, max_bytes, eviction)
+        else:
+            self.index = None
+        self.rescan_interval = float(rescan_interval)
+        self.scanned = None
+        self.scanner = None
+        self.scan_lock = threading.Lock()
+
+    def name(self, key):
+        """Return the file name for ``key``."""
+        if len(key) > self.max_name:
+            return 'sha1-' + sha1(key).hexdigest()
+        return key
+
+    def name_path(self, name):
+        """Return the path of the file called ``name``."""
+        digest = sha1(name).hexdigest()
+        parts = [digest[2 * i:2 * i + 2] for i in range(self.levels)]
+        return os.path.join(self.directory, *(parts + [name]))
+
+    def path(self, key):
+        return self.name_path(self.name(key))
+
+    def files(self):
+        """Yield the path, name and depth of every file in the cache
+        directory, including temporary and lock files."""
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            depth = os.path.relpath(dirpath, self.directory).count(os.sep)
+            if dirpath != self.directory:
+                depth += 1
+            for name in filenames:
+                yield os.path.join(dirpath, name), name, depth
+
+    def scan(self):
+        """Rebuild the index from the files in the cache directory."""
+        self.scan_lock.acquire()
+        try:
+            self._scan(time.time())
+        finally:
+            self.scan_lock.release()
+
+    def start_scan(self):
+        """Run ``scan`` in a background thread unless a scan is
+        running already. Return the thread or ``None``."""
+        if not self.scan_lock.acquire(False):
+            return None
+        now = time.time()
+        def run():
+            try:
+                self._scan(now)
+            finally:
+                self.scan_lock.release()
+        try:
+            self.scanned = now
+            thread = threading.Thread(target=run)
+            thread.setDaemon(True)
+            thread.start()
+        except:
+            self.scan_lock.release()
+            raise
+        self.scanner = thread
+        return thread
+
+    def _scan(self, now):
+        self.scanned = now
+        entries = []
+        for path, name, depth in self.files():
+            try:
+                st = os.stat(path)
+                if name.startswith('.'):
+                    if now - st.st_mtime > self.temp_max_age:
+                        os.remove(path)
+                    continue
+            except OSError:
+                continue
+            # files of another layout are left to ``migrate``
+            if depth == self.levels and stat.S_ISREG(st.st_mode):
+                entries.append((name, st.st_size, st.st_atime))
+        # entries written or read during the scan may have been missed
+        self.index.reset(entries, since=now)
+
+    def migrate(self):
+        """Move the files written with another number of ``levels``
+        (e.g. by earlier versions, which stored all files in the cache
+        directory itself) to where they belong now and remove empty
+        subdirectories. Return the number of files moved."""
+        moved = 0
+        for path, name, depth in list(self.files()):
+            if name.startswith('.') or depth == self.levels:
+                continue
+            target = self.name_path(name)
+            makedirs(os.path.dirname(target))
+            os.rename(path, target)
+            moved += 1
+        for dirpath, dirnames, filenames in os.walk(
+            self.directory, topdown=False):
+            if dirpath != self.directory and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+        self.scanned = None
+        return moved
+
+    def _check_index(self):
+        if self.index is None:
+            return False
+        if self.scanned is None or \
+               time.time() - self.scanned > self.rescan_interval:
+            self.start_scan()
+        return True
+
+    def get(self, key):
+        indexed = self._check_index()
+        name = self.name(key)
+        try:
+            f = open(self.name_path(name), 'rb')
+        except IOError:
+            if indexed:
+                self.index.remove(name)
+            self.counters['misses'] += 1
+            return None
+        try:
+            value = f.read()
+        finally:
+            f.close()
+        if indexed:
+            self.index.touch(name)
+        self.counters['hits'] += 1
+        return value
+
+    def has(self, key):
+        # neither counted nor a use of the entry for eviction
+        return os.path.exists(self.path(key))
+
+    def set(self, key, value):
+        indexed = self._check_index()
+        name = self.name(key)
+        path = self.name_path(name)
+        makedirs(os.path.dirname(path))
+        fd, temp = tempfile.mkstemp(prefix=self.temp_prefix,
+                                    dir=os.path.dirname(path))
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(value)
+            finally:
+                f.close()
+            os.chmod(temp, 0o644)
+            try:
+                os.rename(temp, path)
+            except OSError:
+                # Windows does not replace existing files
+                if not os.path.exists(path):
+                    raise
+                os.remove(path)
+                os.rename(temp, path)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        self.counters['sets'] += 1
+        if indexed:
+            self.index.add(name, len(value))
+            self.compact(self.compact_batch)
+
+    def delete(self, key):
+        name = self.name(key)
+        if self.index is not None:
+            self.index.remove(name)
+        try:
+            os.remove(self.name_path(name))
+        except OSError:
+            return
+        self.counters['deletes'] += 1
+
+    def lock(self, key):
+        """Return a lock for ``key`` which is shared with other
+        processes using the same directory."""
+        if fcntl is None:
+            return None
+        path = self.name_path(self.lock_prefix + sha1(key).hexdigest())
+        makedirs(os.path.dirname(path))
+        return FileLock(path)
+
+    def compact(self, limit=None):
+        """Evict up to ``limit`` files (all that are needed if
+        ``None``) if the cache exceeds its budget."""
+        if not self._check_index():
+            return
+        for name in self.index.victims(limit):
+            try:
+                os.remove(self.name_path(name))
+            except OSError:
+                continue
+            self.counters['evictions'] += 1
+
+    def stats(self):
+        stats = CacheBackend.stats(self)
+        if self.index is not None:
+            stats.update(entries=len(self.index), bytes=self.index.size)
+        return stats
+
+class MemoryCache(CacheBackend):
+    """An in-process cache which evicts the least recently (or least
+    frequently) used entries once it holds more than ``max_entries``
+    entries or ``max_bytes`` bytes."""
+
+    options = ('max_entries', 'max_bytes', 'eviction')
+
+    def __init__(self, max_entries=1000, max_bytes=None, eviction='lru'):
+        CacheBackend.__init__(self)
+        self.index = Index(max_entries, max_bytes, eviction)
+        self.data = {}
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is None:
+            self.counters['misses'] += 1
+            return None
+        self.index.touch(key)
+        self.counters['hits'] += 1
+        return value
+
+    def has(self, key):
+        return key in self.data
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.index.add(key, len(value))
+        self.counters['sets'] += 1
+        for key in self.index.victims():
+            self.data.pop(key, None)
+            self.counters['evictions'] += 1
+
+    def delete(self, key):
+        self.index.remove(key)
+        if self.data.pop(key, None) is not None:
+            self.counters['deletes'] += 1
+
+    def stats(self):
+        stats = CacheBackend.stats(self)
+        stats.update(entries=len(self.data), bytes=self.index.size)
+        return stats
+
+class MemcachedError(Exception):
+    pass
+
+class MemcachedCache(CacheBackend):
+    """A client for the memcached text protocol. Keys are distributed
+    over ``servers`` (a list of ``host:port`` strings) by their CRC32
+    checksum. Connection failures are counted as errors and treated as
+    cache misses so that an unavailable memcached only costs a
+    resize.
+
+    ``has`` uses the meta command ``mg`` of memcached 1.6, which does
+    not send the value; if a server answers it with an error, ``get``
+    is used from then on."""
+
+    max_key_length = 250
+    options = ('servers', 'timeout', 'expire')
+
+    def __init__(self, servers, timeout=1.0, expire=0):
+        CacheBackend.__init__(self)
+        if isinstance(servers, basestring):
+            servers = servers.split()
+        self.servers = []
+        for server in servers:
+            host, port = server.rsplit(':', 1)
+            self.servers.append((host, int(port)))
+        if not self.servers:
+            raise ValueError("Must configure at least one memcached server.")
+        self.timeout = float(timeout)
+        self.expire = int(expire)
+        self.local = threading.local()
+        self.meta = True
+
+    def _key(self, key):
+        if len(key) > self.max_key_length:
+            key = sha1(key).hexdigest()
+        return key
+
+    def _connection(self, key):
+        server = self.servers[(crc32(key) & 0xffffffff) % len(self.servers)]
+        connections = self.local.__dict__.setdefault('connections', {})
+        connection = connections.get(server)
+        if connection is None:
+            sock = socket.create_connection(server, self.timeout)
+            connection = connections[server] = (sock, sock.makefile('rb'))
+        return server, connection
+
+    def _disconnect(self, key):
+        server = self.servers[(crc32(key) & 0xffffffff) % len(self.servers)]
+        connection = getattr(self.local, 'connections', {}).pop(server, None)
+        if connection is not None:
+            connection[0].close()
+
+    def _command(self, key, command, payload=None):
+        server, (sock, f) = self._connection(key)
+        if payload is None:
+            sock.sendall(command + '\r\n')
+        else:
+            sock.sendall(command + '\r\n' + payload + '\r\n')
+        line = f.readline()
+        if not line.endswith('\r\n'):
+            raise MemcachedError("Connection closed by %s:%d." % server)
+        if line.startswith(('ERROR', 'CLIENT_ERROR', 'SERVER_ERROR')):
+            raise MemcachedError(line.strip())
+        return line[:-2], f
+
+    def get(self, key):
+        key = self._key(key)
+        try:
+            line, f = self._command(key, 'get %s' % key)
+            if line == 'END':
+                self.counters['misses'] += 1
+                return None
+            length = int(line.split()[3])
+            value = f.read(length + 2)[:-2]
+            if f.readline() != 'END\r\n':
+                raise MemcachedError("Malformed response.")
+        except (socket.error, MemcachedError, ValueError, IndexError):
+            self._disconnect(key)
+            self.counters['errors'] += 1
+            self.counters['misses'] += 1
+            return None
+        self.counters['hits'] += 1
+        return value
+
+    def has(self, key):
+        key = self._key(key)
+        if self.meta:
+            try:
+                line, f = self._command(key, 'mg %s' % key)
+            except socket.error:
+                self._disconnect(key)
+                self.counters['errors'] += 1
+                return False
+            except MemcachedError:
+                self._disconnect(key)
+                self.meta = False
+            else:
+                return line != 'EN'
+        return self.get(key) is not None
+
+    def set(self, key, value):
+        key = self._key(key)
+        try:
+            line, f = self._command(
+                key, 'set %s 0 %d %d' % (key, self.expire, len(value)), value)
+        except (socket.error, MemcachedError):
+            self._disconnect(key)
+            self.counters['errors'] += 1
+            return
+        if line == 'STORED':
+            self.counters['sets'] += 1
+
+    def delete(self, key):
+        key = self._key(key)
+        try:
+            line, f = self._command(key, 'delete %s' % key)
+        except (socket.error, MemcachedError):
+            self._disconnect(key)
+            self.counters['errors'] += 1
+            return
+        if line == 'DELETED':
+            self.counters['deletes'] += 1
+
+backends = {
+    'file': FileSystemCache,
+    'memory': MemoryCache,
+    'memcached': MemcachedCache,
+    }
+
+def make_cache(cache=None, backend=None, **options):
+    """Return a cache backend configured from (Paste) options.
+
+    ``cache`` is either a backend instance or, for the ``file``
+    backend, the cache directory. ``backend`` selects one of
+    ``file`` (the default), ``memory`` or ``memcached``. Options
+    listed in the ``options`` attribute of the backend are passed on;
+    options which are ``None`` are left to the backend defaults."""
+    if cache is not None and not isinstance(cache, basestring):
+        return cache
+    backend = (backend or 'file').strip().lower()
+    factory = backends.get(backend)
+    if factory is None:
+        raise ValueError("Unknown cache backend: %r." % backend)
+    kw = {}
+    for name in factory.options:
+        if options.get(name) is not None:
+            kw[name] = options[name]
+    if factory is FileSystemCache:
+        if not cache:
+            return None
+        return factory(cache, **kw)
+    return factory(**kw)
+
+def migrate_main(argv=None, out=sys.stdout):
+    """Move the files in a ``file`` cache directory to the layout of
+    this version, or to another number of ``--levels``."""
+    import optparse
+    parser = optparse.OptionParser(
+        usage='%prog [options] DIRECTORY',
+        description='Move the files in a cache directory to the layout '
+        'of this version.')
+    parser.add_option('--levels', type='int', default=None,
+                      help='the number of subdirectory levels (2 by '
+                      'default)')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('expected a single cache directory')
+    kw = {}
+    if options.levels is not None:
+        kw['levels'] = options.levels
+    moved = FileSystemCache(args[0], **kw).migrate()
+    out.write('%d files moved.\n' % moved)
+    return 0
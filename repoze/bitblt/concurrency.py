@@ -0,0 +1,364 @@
+""" Concurrency helpers for the middleware."""
+
+from collections import deque
+import os
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    # not available on Windows; cross-process locking is disabled
+    fcntl = None
+
+class FileLock(object):
+    """An exclusive ``flock`` on ``path`` which is shared between
+    processes. ``acquire`` gives up after ``timeout`` seconds and
+    returns ``False``. The file is removed when the lock is
+    released."""
+
+    poll_interval = 0.01
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self, timeout=None):
+        deadline = timeout is not None and time.time() + timeout
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError:
+                    if deadline and time.time() > deadline:
+                        os.close(fd)
+                        return False
+                    time.sleep(self.poll_interval)
+            # the previous holder may have removed the file we locked,
+            # and another process may have locked a new one since
+            try:
+                current = os.fstat(fd).st_ino == os.stat(self.path).st_ino
+            except OSError:
+                current = False
+            if current:
+                break
+            os.close(fd)
+        self.fd = fd
+        return True
+
+    def release(self):
+        fd, self.fd = self.fd, None
+        if fd is not None:
+            # remove the file while it is still locked, see ``acquire``
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+class Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """Coalesce concurrent calls for the same key so that only one
+    thread does the work while the others wait for its result.
+
+    If ``lock_factory`` is given, it is called with the key and should
+    return a lock (see ``FileLock``) or ``None``; the leading thread
+    holds that lock while it works, which extends coalescing to other
+    processes. The work function should therefore check whether
+    another process has already done the work.
+
+    Waiters give up after ``timeout`` seconds and do the work
+    themselves."""
+
+    def __init__(self, lock_factory=None, timeout=30):
+        self.lock_factory = lock_factory
+        self.timeout = timeout is not None and float(timeout) or None
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        self.lock.acquire()
+        try:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        finally:
+            self.lock.release()
+
+        if not leader:
+            call.event.wait(self.timeout)
+            if not call.event.isSet():
+                return fn()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            try:
+                call.result = self._locked(key, fn)
+            except Exception:
+                call.error = sys.exc_info()[1]
+                raise
+        finally:
+            self.lock.acquire()
+            try:
+                del self.calls[key]
+            finally:
+                self.lock.release()
+            call.event.set()
+        return call.result
+
+    def _locked(self, key, fn):
+        lock = self.lock_factory is not None and self.lock_factory(key)
+        if not lock or not lock.acquire(self.timeout):
+            return fn()
+        try:
+            return fn()
+        finally:
+            lock.release()
+
+class Busy(Exception):
+    """Raised when there is no capacity left to scale an image."""
+
+def guarded(fn, *args):
+    """Call ``fn`` with ``args`` and return whether it succeeded along
+    with its result or exception, so that the callback of
+    ``apply_async`` is called either way."""
+    try:
+        return True, fn(*args)
+    except Exception:
+        return False, sys.exc_info()[1]
+
+class Executor(object):
+    """Run functions in a pool of ``workers`` threads or processes
+    (``kind`` is ``thread`` or ``process``) and wait for their result.
+
+    ``run`` raises ``Busy`` if ``max_queue`` calls are already pending
+    or if the result is not ready after ``timeout`` seconds. A call
+    which timed out stays pending until it finishes. The pool
+    is created on first use in each process, so that it is not shared
+    between forked server processes."""
+
+    def __init__(self, kind='process', workers=None, max_queue=None,
+                 timeout=None):
+        kind = kind.strip().lower()
+        if kind not in ('thread', 'process'):
+            raise ValueError("Unknown executor: %r." % kind)
+        self.kind = kind
+        self.workers = workers and int(workers) or None
+        self.max_queue = max_queue and int(max_queue) or None
+        self.timeout = timeout and float(timeout) or None
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.pool = None
+        self.pid = None
+
+    def _pool(self):
+        if self.pool is None or self.pid != os.getpid():
+            if self.kind == 'thread':
+                from multiprocessing.pool import ThreadPool
+                self.pool = ThreadPool(self.workers)
+            else:
+                from multiprocessing import Pool
+                self.pool = Pool(self.workers)
+            self.pid = os.getpid()
+            self.pending = 0
+        return self.pool
+
+    def _done(self, result):
+        self.lock.acquire()
+        try:
+            self.pending -= 1
+        finally:
+            self.lock.release()
+
+    def run(self, fn, *args):
+        from multiprocessing import TimeoutError
+        self.lock.acquire()
+        try:
+            if self.max_queue is not None and self.pending >= self.max_queue:
+                raise Busy("%d calls pending." % self.pending)
+            pool = self._pool()
+            self.pending += 1
+        finally:
+            self.lock.release()
+        try:
+            result = pool.apply_async(guarded, (fn,) + args,
+                                      callback=self._done)
+        except:
+            self._done(None)
+            raise
+        try:
+            succeeded, value = result.get(self.timeout)
+        except TimeoutError:
+            raise Busy("No result after %s seconds." % self.timeout)
+        if not succeeded:
+            raise value
+        return value
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+            self.pending = 0
+
+class Admission(object):
+    """Admit at most ``max_concurrent`` calls, holding at most
+    ``max_bytes`` bytes of data between them. A call which exceeds
+    ``max_bytes`` on its own is admitted when nothing else is."""
+
+    def __init__(self, max_concurrent=None, max_bytes=None):
+        self.max_concurrent = max_concurrent and int(max_concurrent) or None
+        self.max_bytes = max_bytes and int(max_bytes) or None
+        self.condition = threading.Condition()
+        self.active = 0
+        self.bytes = 0
+
+    def _fits(self, size):
+        if not self.active:
+            return True
+        if self.max_concurrent is not None and \
+               self.active >= self.max_concurrent:
+            return False
+        if self.max_bytes is not None and \
+               self.bytes + size > self.max_bytes:
+            return False
+        return True
+
+    def acquire(self, size, timeout=0):
+        """Admit a call holding ``size`` bytes, waiting up to
+        ``timeout`` seconds (forever if ``None``). Return whether the
+        call was admitted."""
+        deadline = timeout is not None and time.time() + timeout
+        self.condition.acquire()
+        try:
+            while not self._fits(size):
+                if deadline is False:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.active += 1
+            self.bytes += size
+            return True
+        finally:
+            self.condition.release()
+
+    def release(self, size):
+        self.condition.acquire()
+        try:
+            self.active -= 1
+            self.bytes -= size
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+class BackgroundQueue(object):
+    """Run functions in ``workers`` background threads, with at most
+    ``max_queue`` calls waiting for a thread. With ``dedupe``, a call
+    submitted for a key which is already queued or running is dropped.
+    Like the pool of ``Executor``, the threads are started on first use
+    in each process."""
+
+    def __init__(self, workers=1, max_queue=100, dedupe=True):
+        self.workers = int(workers or 1)
+        self.max_queue = max_queue and int(max_queue) or None
+        self.dedupe = dedupe
+        self.condition = threading.Condition()
+        self.jobs = deque()
+        self.keys = {}
+        self.active = 0
+        self.pid = None
+        self.counts = dict(queued=0, duplicate=0, full=0, done=0, failed=0)
+
+    def _start(self):
+        if self.pid == os.getpid():
+            return
+        # calls queued before a fork are left to the parent
+        self.jobs.clear()
+        self.keys.clear()
+        self.active = 0
+        self.pid = os.getpid()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+
+    def submit(self, key, fn, *args):
+        """Queue a call of ``fn`` with ``args`` for ``key``. Return
+        ``False`` if the queue is full."""
+        self.condition.acquire()
+        try:
+            self._start()
+            if self.dedupe and key in self.keys:
+                self.counts['duplicate'] += 1
+                return True
+            if self.max_queue is not None and \
+                   len(self.jobs) >= self.max_queue:
+                self.counts['full'] += 1
+                return False
+            self.jobs.append((key, fn, args))
+            self.keys[key] = self.keys.get(key, 0) + 1
+            self.active += 1
+            self.counts['queued'] += 1
+            self.condition.notify()
+            return True
+        finally:
+            self.condition.release()
+
+    def _work(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.jobs:
+                    self.condition.wait()
+                key, fn, args = self.jobs.popleft()
+            finally:
+                self.condition.release()
+            try:
+                fn(*args)
+            except Exception:
+                # the function reports its own errors
+                status = 'failed'
+            else:
+                status = 'done'
+            self.condition.acquire()
+            try:
+                self.keys[key] -= 1
+                if not self.keys[key]:
+                    del self.keys[key]
+                self.active -= 1
+                self.counts[status] += 1
+                self.condition.notifyAll()
+            finally:
+                self.condition.release()
+
+    def join(self, timeout=None):
+        """Wait until all queued calls are done, for up to ``timeout``
+        seconds. Return whether they are."""
+        deadline = timeout is not None and time.time() + timeout
+        self.condition.acquire()
+        try:
+            while self.active:
+                if deadline is False:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+        finally:
+            self.condition.release()
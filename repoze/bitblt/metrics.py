@@ -0,0 +1,63 @@
+""" Timings and counters for the middleware."""
+
+import socket
+import time
+
+class Stats(object):
+    """Timings (in seconds) and counts collected while handling one
+    request. The middleware stores it in the WSGI environment under
+    ``repoze.bitblt.stats``."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.timings = {}
+        self.counts = {}
+
+    def timing(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0) + seconds
+
+    def since(self, name, start):
+        """Record the time passed since ``start`` as ``name`` and
+        return the current time."""
+        now = time.time()
+        self.timing(name, now - start)
+        return now
+
+    def incr(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+class StatsdClient(object):
+    """Send the stats of each request to a statsd server over UDP.
+    Timings are sent in milliseconds, with ``prefix`` prepended to all
+    names. Errors are ignored; statistics must not break requests."""
+
+    max_packet = 512
+
+    def __init__(self, host='localhost', port=8125, prefix='bitblt'):
+        self.address = (host, int(port))
+        self.prefix = prefix and prefix.rstrip('.') + '.' or ''
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def lines(self, stats):
+        lines = []
+        for name, seconds in sorted(stats.timings.items()):
+            lines.append('%s%s:%d|ms' % (self.prefix, name, seconds * 1000))
+        for name, value in sorted(stats.counts.items()):
+            lines.append('%s%s:%d|c' % (self.prefix, name, value))
+        return lines
+
+    def send(self, packet):
+        try:
+            self.socket.sendto(packet, self.address)
+        except socket.error:
+            pass
+
+    def __call__(self, stats):
+        packet = ''
+        for line in self.lines(stats):
+            if packet and len(packet) + len(line) >= self.max_packet:
+                self.send(packet)
+                packet = ''
+            packet = packet and packet + '\n' + line or line
+        if packet:
+            self.send(packet)
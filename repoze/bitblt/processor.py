@@ -1,9 +1,18 @@
 """ Middleware that transforms images."""
 
 from base64 import urlsafe_b64encode
-import os.path
 import re
+import shutil
+import sys
+import threading
+import time
+import traceback
+from tempfile import SpooledTemporaryFile
+import urlparse
 import webob
+from webob.exc import HTTPForbidden
+from webob.exc import HTTPFound
+from webob.exc import HTTPServiceUnavailable
 
 try:
     import PIL.Image as Image
@@ -13,135 +22,1259 @@ except ImportError:
 
 from cStringIO import StringIO
 
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+from cache import dump_entry
+from cache import load_entry
+from cache import make_cache
+from cache import MemoryCache
+from concurrency import Admission
+from concurrency import BackgroundQueue
+from concurrency import Busy
+from concurrency import Executor
+from concurrency import SingleFlight
+from metrics import Stats
+from metrics import StatsdClient
+from transform import ascii_compatible
+from transform import has_rewritable_tags
 from transform import rewrite_image_tags
-from transform import verify_signature
+from transform import rewrite_image_tags_iter
+from transform import SignatureCache
+from transform import SizeRegistry
 
 re_bitblt = re.compile(r'bitblt-(?P<width>\d+|None)x(?P<height>\d+|None)-(?P<signature>[a-z0-9]+)/')
 
+# upstream headers which are stored along with a cached derivative
+cached_headers = ('Content-Type', 'Last-Modified', 'ETag',
+                  'Cache-Control', 'Expires', 'Vary')
+
+# headers of a transformed response which are passed on to the other
+# clients waiting for the same image; per-request headers such as
+# Set-Cookie are not
+shared_headers = set([name.lower() for name in
+                      cached_headers + ('Retry-After', 'Location')])
+
+# request headers which would make the application answer for one
+# client only, e.g. with 304 Not Modified; they are dropped when the
+# original is fetched for a derivative which other clients share
+conditional_headers = ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE')
+
+# the ETag of the original image is stored under this header along
+# with a cached derivative, which has an ETag of its own; it is not
+# served
+source_etag_header = 'X-Bitblt-Source-ETag'
+
+# output formats which can store an alpha channel
+alpha_formats = ('PNG', 'WEBP', 'GIF', 'AVIF')
+
+class ClosingIterator(object):
+    """Iterate over ``iterable`` and call ``close`` when done."""
+
+    def __init__(self, iterable, close=None):
+        self.iterator = iter(iterable)
+        self.close_callback = close
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.iterator.next()
+
+    __next__ = next
+
+    def close(self):
+        if self.close_callback is not None:
+            self.close_callback()
+
+class FileIterator(object):
+    """A WSGI application iterable over the contents of a file."""
+
+    block_size = 65536
+
+    def __init__(self, f):
+        self.f = f
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.f.read(self.block_size)
+        if not data:
+            raise StopIteration
+        return data
+
+    __next__ = next
+
+    def close(self):
+        self.f.close()
+
+def file_size(f, default=None):
+    """Return the size of the file ``f`` and rewind it."""
+    try:
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(0)
+    except (AttributeError, IOError):
+        return default or 0
+    return size
+
+def fit(image_size, size):
+    """Return the size of an image of ``image_size`` scaled down
+    proportionally to fit into ``size``. This rounds like
+    ``Image.thumbnail``: the width is fitted first and the other side
+    is truncated."""
+    width, height = image_size
+    if width > size[0]:
+        height = max(height * size[0] // width, 1)
+        width = size[0]
+    if height > size[1]:
+        width = max(width * size[1] // height, 1)
+        height = size[1]
+    return width, height
+
+class SourceTooLarge(ValueError):
+    """Raised for original images which are too large to be scaled."""
+
+# raised by Pillow itself when opening images beyond its own limit,
+# whatever ``max_pixels`` is; older versions only warn
+DecompressionBombError = getattr(Image, 'DecompressionBombError', ())
+
+def has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or \
+           'transparency' in image.info
+
+def output_format(image, formats):
+    """Return the first of ``formats`` which ``image`` should be
+    converted to, or ``None`` to keep its format. Animated images are
+    not converted, nor are images with transparency converted to
+    formats without an alpha channel."""
+    if image.format in ('ICO', None) or getattr(image, 'is_animated', False):
+        return None
+    for format in formats:
+        if format == image.format:
+            return None
+        if format in alpha_formats or not has_alpha(image):
+            return format
+    return None
+
+def accepted_types(accept):
+    """Return the media types which are explicitly accepted in the
+    ``Accept`` header ``accept``, ignoring wildcards."""
+    types = set()
+    for part in (accept or '').split(','):
+        params = part.split(';')
+        media_type = params[0].strip().lower()
+        if not media_type or '*' in media_type:
+            continue
+        for param in params[1:]:
+            name, sep, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    if float(value) <= 0:
+                        break
+                except ValueError:
+                    break
+        else:
+            types.add(media_type)
+    return types
+
+def open_image(data, max_pixels=None):
+    """Open the image in the file ``data`` without decoding it.
+
+    ``SourceTooLarge`` is raised if it has more than ``max_pixels``
+    pixels."""
+    try:
+        image = Image.open(data)
+    except DecompressionBombError:
+        raise SourceTooLarge(str(sys.exc_info()[1]))
+    if max_pixels is not None and \
+           image.size[0] * image.size[1] > max_pixels:
+        raise SourceTooLarge("%dx%d image exceeds %d pixels." % (
+            image.size + (max_pixels,)))
+    return image
+
+def save_options(image, quality):
+    """Return the keyword arguments for saving a scaled ``image``."""
+    kw = {'quality': quality}
+    transparency = image.info.get('transparency', None)
+    if transparency is not None:
+        kw['transparency'] = transparency
+
+    # maintian icc_profile if we find it, requires PIL 1.1.7 or greater
+    icc_profile = image.info.get('icc_profile', None)
+    if icc_profile is not None:
+        kw['icc_profile'] = icc_profile
+    return kw
+
+# the chroma subsampling settings PIL accepts for JPEG images
+jpeg_subsamplings = ('4:4:4', '4:2:2', '4:2:0')
+
+def encoder_profile(jpeg_optimize=False, jpeg_progressive=False,
+                    jpeg_subsampling=None, png_compress_level=None,
+                    png_optimize=False, png_quantize=None,
+                    gif_palette='preserve'):
+    """Return the encoder profile for the given (Paste) configuration
+    values as a sorted tuple of ``(name, value)`` pairs. Only options
+    which differ from the defaults are included, so that the default
+    profile is empty."""
+    profile = {}
+    if asbool(jpeg_optimize):
+        profile['jpeg_optimize'] = True
+    if asbool(jpeg_progressive):
+        profile['jpeg_progressive'] = True
+    if jpeg_subsampling and jpeg_subsampling.strip():
+        jpeg_subsampling = jpeg_subsampling.strip()
+        if jpeg_subsampling not in jpeg_subsamplings:
+            raise ValueError("Unknown JPEG subsampling: %r." %
+                             jpeg_subsampling)
+        profile['jpeg_subsampling'] = jpeg_subsampling
+    if isinstance(png_compress_level, basestring):
+        png_compress_level = png_compress_level.strip() or None
+    if png_compress_level is not None:
+        png_compress_level = int(png_compress_level)
+        if not 0 <= png_compress_level <= 9:
+            raise ValueError("PNG compress level must be between 0 and 9.")
+        profile['png_compress_level'] = png_compress_level
+    if asbool(png_optimize):
+        profile['png_optimize'] = True
+    if isinstance(png_quantize, basestring):
+        png_quantize = png_quantize.strip() or None
+    if png_quantize:
+        png_quantize = int(png_quantize)
+        if not 2 <= png_quantize <= 256:
+            raise ValueError("PNG palettes have between 2 and 256 colors.")
+        profile['png_quantize'] = png_quantize
+    gif_palette = (gif_palette or 'preserve').strip().lower()
+    if gif_palette not in ('preserve', 'adaptive'):
+        raise ValueError("Unknown GIF palette: %r." % gif_palette)
+    if gif_palette != 'preserve':
+        profile['gif_palette'] = gif_palette
+    return tuple(sorted(profile.items()))
+
+def unpalette(image, profile):
+    """Return the loaded ``image`` ready to be scaled. With an
+    ``adaptive`` GIF palette in ``profile``, palette GIF images are
+    converted to RGB, so that they are resampled with the configured
+    filter rather than the nearest neighbour and given a new palette
+    when they are saved. Images with a transparent color keep their
+    palette."""
+    if image.format == 'GIF' and image.mode == 'P' and \
+           'transparency' not in image.info and \
+           dict(profile).get('gif_palette') == 'adaptive':
+        return image.convert('RGB')
+    return image
+
+def complete_size(image_size, size):
+    """Fill in the width or height missing from ``size`` with the one
+    of ``image_size``."""
+    if size[0] is None:
+        return image_size[0], size[1]
+    if size[1] is None:
+        return size[0], image_size[1]
+    return size
+
+def encode(image, out, source_format, format, kw, profile=()):
+    """Write ``image``, which was read from a ``source_format`` file,
+    to the file ``out`` in ``format`` if given, with the options of
+    the encoder ``profile`` for that format."""
+    kw = dict(kw)
+    if format is not None and format != source_format:
+        if format in alpha_formats and has_alpha(image):
+            image = image.convert('RGBA')
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        kw.pop('transparency', None)
+    else:
+        format = source_format.upper()
+    profile = dict(profile)
+    if format == 'JPEG':
+        for name in ('optimize', 'progressive', 'subsampling'):
+            if 'jpeg_' + name in profile:
+                kw[name] = profile['jpeg_' + name]
+    elif format == 'PNG':
+        for name in ('compress_level', 'optimize'):
+            if 'png_' + name in profile:
+                kw[name] = profile['png_' + name]
+        colors = profile.get('png_quantize')
+        if colors and image.mode in ('RGB', 'RGBA'):
+            # the fast octree method is the one which keeps alpha
+            image = image.quantize(colors, Image.FASTOCTREE)
+            kw.pop('transparency', None)
+            # otherwise a palette of 256 colors is written
+            bits = 1
+            while 1 << bits < colors:
+                bits += 1
+            kw['bits'] = bits
+    image.save(out, format, **kw)
+
+def render(data, size, out, quality=80, filter=Image.ANTIALIAS,
+           draft_factor=2, max_pixels=None, stats=None, format=None,
+           profile=()):
+    """Read an image from the file ``data``, scale it proportionally
+    to fit into ``size`` and write it to the file ``out``, in
+    ``format`` if given, using the encoder ``profile`` (see
+    ``encoder_profile``). The time spent decoding, resizing and
+    encoding is recorded in ``stats``.
+
+    ``SourceTooLarge`` is raised before the image is decoded if it has
+    more than ``max_pixels`` pixels."""
+    start = time.time()
+    image = open_image(data, max_pixels)
+    if image.format.upper() == 'ICO':
+        # can't save these
+        # so we just return the original
+        data.seek(0)
+        shutil.copyfileobj(data, out)
+        return
+
+    kw = save_options(image, quality)
+    # the size is computed from the size of the original, not of the
+    # draft, so it is the same as the one render_many scales to
+    size = fit(image.size, complete_size(image.size, size))
+    resize = size != image.size
+    if resize and draft_factor and image.format == 'JPEG':
+        # let the decoder scale down in the DCT domain, but keep
+        # enough pixels for the resampling filter to work with
+        width, height = size
+        image.draft(image.mode, (width * draft_factor,
+                                 height * draft_factor))
+    image.load()
+    source_format = image.format
+    if resize:
+        image = unpalette(image, profile)
+    if stats is not None:
+        start = stats.since('decode', start)
+
+    if resize:
+        if image.size != size:
+            image = image.resize(size, filter)
+        if stats is not None:
+            start = stats.since('resize', start)
+
+    encode(image, out, source_format, format, kw, profile)
+    if stats is not None:
+        stats.since('encode', start)
+
+def render_many(data, sizes, quality=80, filter=Image.ANTIALIAS,
+                draft_factor=2, max_pixels=None, stats=None, format=None,
+                profile=()):
+    """Like ``render``, but return the image in the file ``data``
+    scaled to each of ``sizes`` as a list of strings. The image is
+    decoded once, at the resolution the largest size needs, and each
+    smaller size is scaled from the next larger one."""
+    start = time.time()
+    image = open_image(data, max_pixels)
+    if image.format.upper() == 'ICO':
+        data.seek(0)
+        body = data.read()
+        return [body for size in sizes]
+
+    kw = save_options(image, quality)
+    source_format = image.format
+    targets = [fit(image.size, complete_size(image.size, size))
+               for size in sizes]
+    order = sorted(range(len(sizes)), reverse=True,
+                   key=lambda i: targets[i][0] * targets[i][1])
+    if draft_factor and source_format == 'JPEG' and order:
+        width, height = targets[order[0]]
+        image.draft(image.mode, (width * draft_factor,
+                                 height * draft_factor))
+    image.load()
+    if [target for target in targets if target != image.size]:
+        image = unpalette(image, profile)
+    if stats is not None:
+        start = stats.since('decode', start)
+
+    bodies = [None] * len(sizes)
+    for i in order:
+        if targets[i] != image.size:
+            image = image.resize(targets[i], filter)
+            if stats is not None:
+                start = stats.since('resize', start)
+        out = StringIO()
+        encode(image, out, source_format, format, kw, profile)
+        bodies[i] = out.getvalue()
+        if stats is not None:
+            start = stats.since('encode', start)
+    return bodies
+
+def render_string(data, size, options):
+    """Return the image in the string ``data`` scaled to ``size`` and
+    the timings of ``render``. This is the function run by
+    executors."""
+    out = StringIO()
+    stats = Stats()
+    render(StringIO(data), size, out, stats=stats, **options)
+    return out.getvalue(), stats.timings
+
+def render_many_strings(data, sizes, options):
+    """Return the image in the string ``data`` scaled to each of
+    ``sizes`` and the timings of ``render_many``, for executors."""
+    stats = Stats()
+    bodies = render_many(StringIO(data), sizes, stats=stats, **options)
+    return bodies, stats.timings
+
+def unconditional(environ):
+    """Return a copy of ``environ`` without ``conditional_headers``."""
+    environ = environ.copy()
+    for name in conditional_headers:
+        environ.pop(name, None)
+    return environ
+
+def drop_validators(response):
+    """Remove the ``ETag`` and ``Last-Modified`` headers from
+    ``response``, which stands in for a scaled image, and return it.
+    Otherwise clients would revalidate their copy of it as the scaled
+    image and keep it."""
+    for name in ('ETag', 'Last-Modified'):
+        if name in response.headers:
+            del response.headers[name]
+    return response
+
+def make_response(headerlist, body, status='200 OK'):
+    response = webob.Response()
+    response.status = status
+    response.headerlist = [(name, value) for name, value in headerlist
+                           if name != source_etag_header]
+    response.body = body
+    return response
+
+def file_digest(f, block_size=65536):
+    """Return the SHA-1 hex digest of the contents of the file ``f``
+    and rewind it."""
+    digest = sha1()
+    f.seek(0)
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        digest.update(block)
+    f.seek(0)
+    return digest.hexdigest()
+
+def file_etag(f):
+    """Return a strong ETag for the contents of the file ``f``."""
+    return '"%s"' % file_digest(f)
+
+def parse_size(width, height):
+    """Return the size for the width and height given in a URL, where
+    ``None`` leaves one of them open."""
+    if width in (None, 'None'):
+        width = None
+    else:
+        width = int(width)
+    if height in (None, 'None'):
+        height = None
+    else:
+        height = int(height)
+    return width, height
+
+def asbool(value):
+    """Convert a (Paste) configuration value to a boolean."""
+    if isinstance(value, basestring):
+        value = value.strip().lower()
+        if value in ('true', 'yes', 'on', 'y', 't', '1'):
+            return True
+        if value in ('false', 'no', 'off', 'n', 'f', '0', ''):
+            return False
+        raise ValueError("String is not true/false: %r." % value)
+    return bool(value)
+
+def resolve(name):
+    """Resolve a dotted name such as ``package.module:callable``."""
+    if ':' in name:
+        module, attr = name.split(':', 1)
+    else:
+        module, attr = name.rsplit('.', 1)
+    obj = __import__(module, {}, {}, [attr])
+    for part in attr.split('.'):
+        obj = getattr(obj, part)
+    return obj
+
+def head_revalidator(app):
+    """Return a revalidation hook which issues a HEAD request to
+    ``app`` and considers a cached derivative fresh as long as the
+    ``ETag`` and ``Last-Modified`` headers of the original image have
+    not changed. The conditional headers of the client are not passed
+    on, as they refer to the derivative; should the application
+    answer ``304 Not Modified`` anyway, the derivative is fresh."""
+    def revalidate(environ, headers):
+        request = webob.Request(unconditional(environ))
+        request.method = 'HEAD'
+        response = request.get_response(app)
+        if response.status_int == 304:
+            return True
+        if response.status_int != 200:
+            return False
+        stored = dict(headers)
+        # entries written by older versions store the original ETag
+        stored['ETag'] = stored.get(source_etag_header, stored.get('ETag'))
+        for name in ('ETag', 'Last-Modified'):
+            value = stored.get(name)
+            if value and response.headers.get(name) != value:
+                return False
+        return True
+    return revalidate
+
 class ImageTransformationMiddleware(object):
     def __init__(self, app, global_conf=None, quality=80,
                  secret=None, filter='antialias',
                  limit_to_application_url=False,
                  try_xhtml=False, # BBB
-                 cache=None):
+                 cache=None, revalidate='head', cache_backend=None,
+                 cache_servers=None, cache_max_entries=None,
+                 cache_max_bytes=None, cache_eviction=None,
+                 coalesce_timeout=30, draft_factor=2,
+                 spool_threshold=1048576, executor=None,
+                 executor_workers=None, executor_queue=None,
+                 executor_timeout=None, max_concurrent_resizes=None,
+                 max_queued_bytes=None, overload_policy='reject',
+                 overload_timeout=10, retry_after=1, max_pixels=None,
+                 max_source_bytes=None, oversize_policy='reject',
+                 stream_html=False, signature_cache_size=1024,
+                 metrics=None, statsd_host='localhost', statsd_port=8125,
+                 statsd_prefix='bitblt', output_formats=None,
+                 max_age=None, immutable=False, cache_keys='url',
+                 cache_levels=None, html_cache_max_bytes=None,
+                 html_cache_max_entries=None, sibling_sizes=0,
+                 background=None, background_workers=1,
+                 background_queue=100, background_dedupe=True,
+                 preview_size=32, jpeg_optimize=False,
+                 jpeg_progressive=False, jpeg_subsampling=None,
+                 png_compress_level=None, png_optimize=False,
+                 png_quantize=None, gif_palette='preserve'):
         if secret is None:
             raise ValueError("Must configure ``secret``.")
 
         self.quality = int(quality)
         self.app = app
         self.secret = secret
-        self.filter = {
+        self.signatures = SignatureCache(secret, signature_cache_size)
+        filters = {
             'nearest': Image.NEAREST,
             'bilinear': Image.BILINEAR,
             'bicubic': Image.BICUBIC,
             'antialias': Image.ANTIALIAS,
-        }.get(filter.lower(), 'antialias')
+        }
+        filter = filter.lower()
+        if filter not in filters:
+            filter = 'antialias'
+        self.filter_name = filter
+        self.filter = filters[filter]
         self.limit_to_application_url = limit_to_application_url
-        self.cache = cache
+        self.stream_html = asbool(stream_html)
+        self.draft_factor = int(draft_factor)
+        self.profile = encoder_profile(
+            jpeg_optimize, jpeg_progressive, jpeg_subsampling,
+            png_compress_level, png_optimize, png_quantize, gif_palette)
+        self.spool_threshold = int(spool_threshold)
+        self.cache = make_cache(
+            cache, cache_backend, servers=cache_servers,
+            max_entries=cache_max_entries, max_bytes=cache_max_bytes,
+            eviction=cache_eviction, levels=cache_levels)
+        if html_cache_max_bytes:
+            self.html_cache = MemoryCache(
+                html_cache_max_entries or None, html_cache_max_bytes)
+        else:
+            self.html_cache = None
+        sibling_sizes = int(sibling_sizes or 0)
+        if sibling_sizes > 0:
+            self.siblings = SizeRegistry(sibling_sizes)
+        else:
+            self.siblings = None
+        if isinstance(revalidate, basestring):
+            revalidate = revalidate.strip() or 'head'
+            if revalidate == 'head':
+                revalidate = head_revalidator(app)
+            elif revalidate == 'never':
+                revalidate = None
+            else:
+                revalidate = resolve(revalidate)
+        self.revalidate = revalidate
+        cache_keys = cache_keys.strip().lower()
+        if cache_keys not in ('url', 'content'):
+            raise ValueError("Unknown cache keys: %r." % cache_keys)
+        self.cache_keys = cache_keys
+        self.flight = SingleFlight(
+            getattr(self.cache, 'lock', None), coalesce_timeout)
+        if executor and executor.strip():
+            executor = Executor(executor, executor_workers, executor_queue,
+                                executor_timeout)
+        else:
+            executor = None
+        self.executor = executor
+        self.admission = Admission(max_concurrent_resizes, max_queued_bytes)
+        overload_policy = overload_policy.strip().lower()
+        if overload_policy not in ('reject', 'original', 'wait'):
+            raise ValueError("Unknown overload policy: %r." % overload_policy)
+        self.overload_policy = overload_policy
+        self.overload_timeout = float(overload_timeout)
+        self.retry_after = int(retry_after)
+        self.max_pixels = max_pixels and int(max_pixels) or None
+        self.max_source_bytes = max_source_bytes and int(max_source_bytes) \
+                                or None
+        oversize_policy = oversize_policy.strip().lower()
+        if oversize_policy not in ('reject', 'original'):
+            raise ValueError("Unknown oversize policy: %r." % oversize_policy)
+        self.oversize_policy = oversize_policy
+        if isinstance(metrics, basestring):
+            metrics = metrics.strip()
+            if metrics == 'statsd':
+                metrics = StatsdClient(statsd_host, statsd_port,
+                                       statsd_prefix)
+            else:
+                metrics = metrics and resolve(metrics) or None
+        self.metrics = metrics
+        if isinstance(output_formats, basestring):
+            output_formats = output_formats.replace(',', ' ').split()
+        Image.init()
+        # formats which PIL cannot write are ignored
+        self.output_formats = tuple([
+            format.upper() for format in output_formats or ()
+            if format.upper() in Image.SAVE and
+            format.upper() in Image.MIME])
+        if isinstance(max_age, basestring):
+            max_age = max_age.strip() or None
+        if max_age is not None:
+            max_age = int(max_age)
+        self.max_age = max_age
+        self.immutable = asbool(immutable)
+        if background and background.strip():
+            background = background.strip().lower()
+            if background not in ('original', 'preview', 'redirect'):
+                raise ValueError("Unknown background fallback: %r." %
+                                 background)
+            self.background = BackgroundQueue(
+                background_workers, background_queue,
+                asbool(background_dedupe))
+        else:
+            background = None
+            self.background = None
+        self.background_fallback = background
+        self.preview_size = int(preview_size)
+        self.counts = {}
+        self.counts_lock = threading.Lock()
 
-    def process(self, data, size):
-        image = Image.open(data)
-        if image.format.upper() == 'ICO':
-            # can't save these
-            # so we just return the original
-            return data
-
-        kw = {'quality': self.quality}
-        transparency = image.info.get('transparency', None)
-        if transparency is not None:
-            kw['transparency'] = transparency
-
-        # maintian icc_profile if we find it, requires PIL 1.1.7 or greater
-        icc_profile = image.info.get('icc_profile', None)
-        if icc_profile is not None:
-            kw['icc_profile'] = icc_profile
-
-        if size != image.size:
-            if size[0] is None:
-                size = (image.size[0], size[1])
-            elif size[1] is None:
-                size = (size[0], image.size[1])
-            image.thumbnail(size, self.filter)
-
-        f = StringIO()
-        image.save(f, image.format.upper(), **kw)
-        return f.getvalue()
+    def spool(self, app_iter, limit=None):
+        """Copy an application iterable into a file which is kept in
+        memory up to ``spool_threshold`` bytes and on disk beyond. If
+        more than ``limit`` bytes are copied, the rest is not read and
+        the file is left incomplete."""
+        f = SpooledTemporaryFile(self.spool_threshold)
+        try:
+            for chunk in app_iter:
+                f.write(chunk)
+                if limit is not None and f.tell() > limit:
+                    break
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        f.seek(0)
+        return f
 
-    def __call__(self, environ, start_response):
-        path_info = environ['PATH_INFO']
-        m = re_bitblt.search(path_info)
-        if m is not None:
-            width = m.group('width')
-            height = m.group('height')
-            signature = m.group('signature')
-            verified = verify_signature(width, height, self.secret, signature)
+    def url_key(self, path_info, formats=()):
+        """Return the cache key for a request for ``path_info`` from a
+        client which accepts ``formats``. With content keys, the entry
+        stored under this key is the content key of the image."""
+        if formats:
+            path_info += '.' + '.'.join(formats).lower()
+        if self.cache_keys == 'content':
+            return 'url-' + sha1(path_info).hexdigest()
+        return urlsafe_b64encode(path_info)
 
-            # remove bitblt part in path info
-            full_path_info = path_info
-            environ['PATH_INFO'] = re_bitblt.sub("", path_info)
+    def content_key(self, data, size, format=None):
+        """Return the content key of the image read from the file
+        ``data`` scaled to ``size`` and converted to ``format``; it
+        identifies the scaled image no matter which URL it is served
+        from."""
+        options = sorted(self.render_options().items())
+        return 'img-' + sha1('%s:%r:%r:%s' % (
+            file_digest(data), size, options, format)).hexdigest()
+
+    def sibling_keys(self, request, size, formats=()):
+        """Return the other sizes the image requested by ``request``
+        was shown at on rewritten pages and which are not cached yet,
+        with their cache keys."""
+        siblings = []
+        for width, height in self.siblings.get(request.path):
+            try:
+                sibling = parse_size(width, height)
+            except ValueError:
+                continue
+            if sibling == size:
+                continue
+            parts = request.path_info.split('/')
+            parts.insert(-1, 'bitblt-%sx%s-%s' % (
+                width, height, self.signatures(width, height)))
+            cache_key = self.url_key('/'.join(parts), formats)
+            if not self.cache.has(cache_key):
+                siblings.append((sibling, cache_key))
+        return siblings
+
+    def size_recorder(self, request):
+        """Return a ``found`` callback for ``rewrite_image_tags`` which
+        records the sizes of the images on the page of ``request``."""
+        host = urlparse.urlparse(request.host_url)[1]
+        def found(src, width, height):
+            scheme, netloc, path = urlparse.urlparse(
+                urlparse.urljoin(request.path, src))[:3]
+            if not netloc or netloc == host:
+                self.siblings.add(path, width, height)
+        return found
+
+    def lookup(self, cache_key):
+        """Return the raw cache data and the ``(headers, body)`` entry
+        for ``cache_key``, or ``(None, None)`` if there is no usable
+        entry."""
+        if self.cache_keys == 'content':
+            content_key = self.cache.get(cache_key)
+            if content_key is None:
+                return None, None
+            cache_key = content_key
+        return self.load(cache_key)
+
+    def load(self, cache_key):
+        """Like ``lookup``, but without resolving content keys."""
+        data = self.cache.get(cache_key)
+        if data is None:
+            return None, None
+        entry = load_entry(data)
+        if entry is None:
+            # corrupt or written by an older version; regenerate it
+            self.cache.delete(cache_key)
+            return None, None
+        return data, entry
+
+    def is_fresh(self, request, entry):
+        """Return whether a cached entry may be served. The wrapped
+        application is only called if the revalidation hook asks it to
+        be, which the default ``head`` hook does."""
+        if self.revalidate is None:
+            return True
+        return self.revalidate(request.environ.copy(), entry[0])
+
+    def render_options(self):
+        """Return the keyword arguments for ``render``."""
+        options = dict(quality=self.quality, filter=self.filter,
+                       draft_factor=self.draft_factor,
+                       max_pixels=self.max_pixels)
+        # the default profile is left out to keep content keys as
+        # they were
+        if self.profile:
+            options['profile'] = self.profile
+        return options
+
+    def process(self, data, size, out=None, stats=None, format=None):
+        """Return the image read from the file ``data`` scaled to
+        ``size`` and converted to ``format`` if given. If ``out`` is
+        given, the image is written to that file instead. Timings and
+        counts are recorded in ``stats``.
+
+        With an executor, the image is read into a string and scaled
+        in the executor's pool while the calling thread waits."""
+        if stats is None:
+            stats = Stats()
+        stats.incr('resize.%s' % self.filter_name)
+        options = self.render_options()
+        options['format'] = format
+        if self.executor is not None:
+            start = time.time()
+            body, timings = self.executor.run(
+                render_string, data.read(), size, options)
+            stats.since('executor', start)
+            for name, seconds in timings.items():
+                stats.timing(name, seconds)
+            if out is None:
+                return body
+            out.write(body)
+            return
+        if out is None:
+            f = StringIO()
+            render(data, size, f, stats=stats, **options)
+            return f.getvalue()
+        render(data, size, out, stats=stats, **options)
+
+    def process_many(self, data, sizes, stats=None, format=None):
+        """Return a list of the image read from the file ``data``
+        scaled to each of ``sizes`` and converted to ``format`` if
+        given. The image is decoded only once."""
+        if stats is None:
+            stats = Stats()
+        stats.incr('resize.%s' % self.filter_name, len(sizes))
+        options = self.render_options()
+        options['format'] = format
+        if self.executor is not None:
+            start = time.time()
+            bodies, timings = self.executor.run(
+                render_many_strings, data.read(), sizes, options)
+            stats.since('executor', start)
+            for name, seconds in timings.items():
+                stats.timing(name, seconds)
+            return bodies
+        return render_many(data, sizes, stats=stats, **options)
+
+    def acceptable_formats(self, environ):
+        """Return the configured output formats which the client
+        accepts, in order of preference."""
+        if not self.output_formats:
+            return ()
+        types = accepted_types(environ.get('HTTP_ACCEPT'))
+        return tuple([format for format in self.output_formats
+                      if Image.MIME[format] in types])
+
+    def record(self, stats):
+        """Add the counts of a request to ``counts`` and pass its stats
+        on to the ``metrics`` sink."""
+        self.counts_lock.acquire()
+        try:
+            for name, value in stats.counts.items():
+                self.counts[name] = self.counts.get(name, 0) + value
+        finally:
+            self.counts_lock.release()
+        if self.metrics is not None:
+            self.metrics(stats)
+
+    def cache_hit_ratio(self):
+        """Return the share of image requests served from the cache,
+        or ``None`` before the first one."""
+        hits = self.counts.get('cache.hit', 0)
+        total = hits + self.counts.get('cache.miss', 0)
+        return total and float(hits) / total or None
+
+    def coalesced_response(self, request, cache_key, size, stale=None):
+        """Return the transformed response for a cache miss. Concurrent
+        requests for the same image share the work of the first one;
+        other responses than ``200 OK`` are not shared, and unless
+        revalidation is off, each client is revalidated like on a cache
+        hit before it is given the image. ``stale`` is the cache data
+        which was found to be stale, if any."""
+        # the client's own conditional headers are answered later
+        request = webob.Request(unconditional(request.environ))
+        worked = []
+        def work():
+            worked.append(True)
+            # another process may have stored the image in the meantime
+            data, entry = self.lookup(cache_key)
+            if data is not None and data != stale and \
+                   self.is_fresh(request, entry):
+                return ('200 OK',) + entry
+            response = self.transform_response(request, size, cache_key)
+            headerlist = [(name, value) for name, value in response.headerlist
+                          if name.lower() in shared_headers]
+            return response.status, headerlist, response.body
+
+        while True:
+            status, headerlist, body = self.flight.do(cache_key, work)
+            if worked or self.revalidate is None and status.startswith('200'):
+                return make_response(headerlist, body, status)
+            if status.startswith('200'):
+                # the application may not give this client the image
+                data, entry = self.lookup(cache_key)
+                if entry is not None and self.is_fresh(request, entry):
+                    return make_response(*entry)
+                return self.transform_response(request, size, cache_key)
+
+    def background_response(self, request, cache_key, size, stale=None):
+        """Queue the transformation for a cache miss and return a
+        fallback response right away: the original image, a preview
+        or a redirect to the original image. If the queue is full, the
+        image is transformed while the client waits."""
+        environ = unconditional(request.environ)
+        if not self.background.submit(
+                cache_key, self.generate, environ, cache_key, size, stale):
+            request.environ['repoze.bitblt.stats'].incr('background.full')
+            return self.coalesced_response(request, cache_key, size, stale)
+        request.environ['repoze.bitblt.stats'].incr('background.queued')
+
+        if self.background_fallback == 'redirect':
+            location = request.path_url
+            if request.query_string:
+                location += '?' + request.query_string
+            response = HTTPFound(location=location)
         else:
-            verified = width = height = None
+            response = request.get_response(self.app)
+            if response.status_int == 200 and response.content_type and \
+                   response.content_type.startswith('image/') and \
+                   self.background_fallback == 'preview':
+                response = self.preview(response)
+            if response.status_int == 200:
+                drop_validators(response)
+        # the client should come back for the scaled image
+        response.cache_control = 'no-cache'
+        return response
 
-        request = webob.Request(environ)
+    def generate(self, environ, cache_key, size, stale=None):
+        """Transform and cache the image for a request made with
+        ``environ``; this runs in the background, so errors are written
+        to the request's ``wsgi.errors`` stream."""
+        stats = environ['repoze.bitblt.stats'] = Stats()
+        try:
+            self.coalesced_response(webob.Request(environ), cache_key, size,
+                                    stale)
+        except Exception:
+            traceback.print_exc(file=environ['wsgi.errors'])
+            raise
+        stats.since('total', stats.start)
+        self.record(stats)
+
+    def preview(self, response):
+        """Return ``response`` with its image scaled to fit into
+        ``preview_size`` pixels as cheaply as possible. Only JPEG
+        images can be decoded at a fraction of their size; other
+        images are answered with the original, which is cheaper than
+        decoding them in full on the request thread."""
+        app_iter = response.app_iter
+        if not hasattr(app_iter, 'read'):
+            app_iter = self.spool(app_iter)
+        try:
+            format = open_image(app_iter, self.max_pixels).format
+        except SourceTooLarge:
+            return self.oversized(response, app_iter, file_size(app_iter))
+        except IOError:
+            format = None
+        if format != 'JPEG':
+            source_size = file_size(app_iter)
+            response.app_iter = FileIterator(app_iter)
+            response.content_length = source_size
+            return response
+        app_iter.seek(0)
+        out = StringIO()
+        render(app_iter, (self.preview_size, self.preview_size), out,
+               self.quality, Image.NEAREST, 1, self.max_pixels)
+        app_iter.close()
+        response.body = out.getvalue()
+        return drop_validators(response)
+
+    def transform_response(self, request, size=None, cache_key=None):
+        """Call the wrapped application and transform its response,
+        rewriting HTML documents and resizing images to ``size``."""
+        stats = request.environ.setdefault('repoze.bitblt.stats', Stats())
+        start = time.time()
         response = request.get_response(self.app)
+        start = stats.since('app', start)
 
         if response.content_type and \
                response.content_type.startswith('text/html') and \
                response.charset:
-            if not len(response.body):
-                return response(environ, start_response)
             if self.limit_to_application_url:
                 app_url = request.application_url
             else:
                 app_url = None
+            if self.siblings is not None:
+                found = self.size_recorder(request)
+            else:
+                found = None
+
+            if self.stream_html:
+                app_iter = response.app_iter
+                response.app_iter = ClosingIterator(
+                    rewrite_image_tags_iter(
+                        app_iter, self.secret, app_url=app_url,
+                        encoding=response.charset,
+                        signatures=self.signatures, found=found),
+                    getattr(app_iter, 'close', None))
+                response.content_length = None
+                return response
+
+            # most documents have no images to rewrite; pass them on
+            # without decoding and encoding them
+            body = response.body
+            if not len(body) or ascii_compatible(response.charset) and \
+                   not has_rewritable_tags(body):
+                stats.incr('html.skipped')
+                return response
+
+            html_key = None
+            if self.html_cache is not None:
+                html_key = self.html_key(request, response, app_url)
+                rewritten = self.html_cache.get(html_key)
+                if rewritten is not None:
+                    response.body = rewritten
+                    stats.since('rewrite', start)
+                    stats.incr('html_cache.hit')
+                    return response
+                stats.incr('html_cache.miss')
 
             response.unicode_body = rewrite_image_tags(
                 response.unicode_body, self.secret,
-                app_url=app_url)
+                app_url=app_url, signatures=self.signatures, found=found)
+            if html_key is not None:
+                self.html_cache.set(html_key, response.body)
+            stats.since('rewrite', start)
+            stats.incr('html.rewritten')
 
         if response.content_type and response.content_type.startswith('image/'):
-            if verified and (width or height):
-                try:
-                    if width == 'None':
-                        width = None
-                    else:
-                        width = int(width)
-                    if height == 'None':
-                        height = None
-                    else:
-                        height = int(height)
-                    size = (width, height)
-                except (ValueError, TypeError):
-                    raise ValueError(
-                        "Width and height parameters must be integers.")
-
+            if size is not None:
                 if request.method == 'HEAD':
                     # Remove the content_lenght header as it's guarenteed
                     # to be wrong. If this were not a HEAD, we would resize.
                     response.content_length = None
                     # Don't attempt to resize, our body may not be there.
-                    return response(environ, start_response)
+                    return response
 
-                app_iter = response.app_iter
-                if not hasattr(app_iter, 'read'):
-                    app_iter = StringIO("".join(app_iter))
-
-                if self.cache:
-                    cache_key = urlsafe_b64encode(full_path_info)
-                    cache_file = os.path.join(self.cache, cache_key)
-                    if os.path.exists(cache_file):
-                        f = open(cache_file)
-                        body = f.read()
-                        f.close()
+                formats = self.acceptable_formats(request.environ)
+                siblings = ()
+                if self.siblings is not None and cache_key is not None:
+                    siblings = self.sibling_keys(request, size, formats)
+                return self.transform_image(
+                    response, size, cache_key, stats, formats, siblings)
+
+        return response
+
+    def html_key(self, request, response, app_url=None):
+        """Return the key of the rewritten ``response`` in the HTML
+        cache: the URL and a strong ``ETag`` if the application gives
+        one, and a digest of the document otherwise."""
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            source = 'etag:%s:%s' % (request.url, etag)
+        else:
+            source = 'body:' + sha1(response.body).hexdigest()
+        return sha1('%s:%s:%s:%s' % (
+            source, response.charset, app_url, self.secret)).hexdigest()
+
+    def transform_image(self, response, size, cache_key=None, stats=None,
+                        formats=(), siblings=()):
+        """Scale the image in ``response`` to ``size``, subject to
+        admission control. The image is converted to the first of
+        ``formats`` it is eligible for. ``siblings`` are other
+        ``(size, cache_key)`` pairs to scale it to and cache along."""
+        if stats is None:
+            stats = Stats()
+        if self.max_source_bytes is not None and \
+               response.content_length is not None and \
+               response.content_length > self.max_source_bytes:
+            # don't even read the body
+            return self.oversized(response)
+        app_iter = response.app_iter
+        if not hasattr(app_iter, 'read'):
+            start = time.time()
+            limit = None
+            if self.oversize_policy != 'original':
+                # an oversized original is only needed in full to be
+                # answered with
+                limit = self.max_source_bytes
+            app_iter = self.spool(app_iter, limit)
+            stats.since('spool', start)
+        source_size = file_size(app_iter, response.content_length)
+        if self.max_source_bytes is not None and \
+               source_size > self.max_source_bytes:
+            return self.oversized(response, app_iter, source_size)
+
+        format = None
+        if formats:
+            # only the header is read
+            try:
+                format = output_format(
+                    open_image(app_iter, self.max_pixels), formats)
+            except SourceTooLarge:
+                return self.oversized(response, app_iter, source_size)
+            except IOError:
+                # not an image we can read; left to process to fail
+                pass
+            app_iter.seek(0)
+
+        if cache_key is not None and self.cache_keys == 'content' and \
+               response.status_int == 200:
+            content_key = self.content_key(app_iter, size, format)
+            data, entry = self.load(content_key)
+            if entry is not None:
+                # the same image was scaled for another URL
+                stats.incr('cache.shared')
+                self.cache.set(cache_key, content_key)
+                app_iter.close()
+                return make_response(*entry)
+        else:
+            content_key = None
+
+        if not self.admission.acquire(source_size):
+            admitted = False
+            if self.overload_policy == 'wait':
+                stats.incr('overload.wait')
+                start = time.time()
+                admitted = self.admission.acquire(
+                    source_size, self.overload_timeout)
+                stats.since('admission', start)
+                if not admitted:
+                    stats.incr('overload.timeout')
+            if not admitted:
+                return self.overloaded(response, app_iter, source_size,
+                                       stats)
+        try:
+            try:
+                if format is not None:
+                    response.content_type = Image.MIME[format]
+                if self.output_formats and \
+                       'Accept' not in (response.vary or ()):
+                    response.vary = tuple(response.vary or ()) + ('Accept',)
+                source_etag = response.headers.get('ETag', '')
+                if cache_key is not None and response.status_int == 200:
+                    if siblings:
+                        bodies = self.process_many(
+                            app_iter, [size] + [sibling for sibling, key
+                                                in siblings],
+                            stats, format)
+                        body = bodies[0]
                     else:
-                        body = self.process(app_iter, size)
-                        f = open(cache_file, 'w+')
-                        f.write(body)
-                        f.close()
+                        body = self.process(app_iter, size, stats=stats,
+                                            format=format)
+                    response.body = body
+                    length = len(body)
+                    self.set_caching_headers(
+                        response, '"%s"' % sha1(body).hexdigest())
+                    headers = [(name, response.headers[name])
+                               for name in cached_headers
+                               if name in response.headers]
+                    headers.append((source_etag_header, source_etag))
+                    start = time.time()
+                    self.store(cache_key, content_key,
+                               dump_entry(headers, body))
+                    if siblings:
+                        self.store_siblings(siblings, bodies[1:], headers,
+                                            content_key and app_iter, format)
+                        stats.incr('cache.sibling', len(siblings))
+                    stats.since('cache.set', start)
                 else:
-                    body = self.process(app_iter, size)
-                response.body = body
+                    out = SpooledTemporaryFile(self.spool_threshold)
+                    self.process(app_iter, size, out, stats, format)
+                    length = out.tell()
+                    if response.status_int == 200:
+                        self.set_caching_headers(response, file_etag(out))
+                    out.seek(0)
+                    response.app_iter = FileIterator(out)
+                    response.content_length = length
+            except Busy:
+                return self.overloaded(response, app_iter, source_size,
+                                       stats)
+            except SourceTooLarge:
+                return self.oversized(response, app_iter, source_size)
+        finally:
+            self.admission.release(source_size)
+        stats.incr('bytes.in', source_size)
+        stats.incr('bytes.out', length)
+        return response
+
+    def store(self, cache_key, content_key, data):
+        """Store the cache ``data`` under ``cache_key``, or under
+        ``content_key`` with ``cache_key`` pointing to it."""
+        if content_key is not None:
+            self.cache.set(content_key, data)
+            self.cache.set(cache_key, content_key)
+        else:
+            self.cache.set(cache_key, data)
+
+    def store_siblings(self, siblings, bodies, headers, data=None,
+                       format=None):
+        """Store the scaled images ``bodies`` for ``siblings`` with the
+        cached ``headers`` of the requested size, but ETags of their
+        own. ``data`` is the original image for content keys."""
+        for (size, cache_key), body in zip(siblings, bodies):
+            etag = '"%s"' % sha1(body).hexdigest()
+            entry = dump_entry([(name, name == 'ETag' and etag or value)
+                                for name, value in headers], body)
+            if data is not None:
+                self.store(cache_key, self.content_key(data, size, format),
+                           entry)
+            else:
+                self.store(cache_key, None, entry)
+
+    def set_caching_headers(self, response, etag):
+        """Give a scaled image the ETag ``etag`` of its own and, if
+        ``max_age`` is set, a ``Cache-Control`` header which replaces
+        the one of the original image."""
+        response.headers['ETag'] = etag
+        if self.max_age is not None:
+            cache_control = 'public, max-age=%d' % self.max_age
+            if self.immutable:
+                cache_control += ', immutable'
+            response.headers['Cache-Control'] = cache_control
+            if 'Expires' in response.headers:
+                del response.headers['Expires']
+
+    def oversized(self, response, app_iter=None, source_size=None):
+        """Return the response for an image which is too large to be
+        scaled; either the original image or ``403 Forbidden``."""
+        if self.oversize_policy == 'original':
+            if app_iter is not None:
+                app_iter.seek(0)
+                response.app_iter = FileIterator(app_iter)
+                response.content_length = source_size
+            return drop_validators(response)
+        if app_iter is None and hasattr(response.app_iter, 'close'):
+            response.app_iter.close()
+        return HTTPForbidden("The original image is too large to be scaled.")
+
+    def overloaded(self, response, app_iter, source_size, stats):
+        """Return the response for an image which cannot be scaled now;
+        either the original image or ``503 Service Unavailable``. This
+        is counted in ``stats``."""
+        if self.overload_policy == 'original':
+            stats.incr('overload.original')
+            app_iter.seek(0)
+            response.app_iter = FileIterator(app_iter)
+            response.content_length = source_size
+            # the client should come back for the scaled image
+            response.cache_control = 'no-cache'
+            return drop_validators(response)
+        stats.incr('overload.reject')
+        return HTTPServiceUnavailable(
+            "Too many images are being scaled.",
+            headers=[('Retry-After', str(self.retry_after))])
+
+    def __call__(self, environ, start_response):
+        stats = environ['repoze.bitblt.stats'] = Stats()
+        path_info = environ['PATH_INFO']
+        m = re_bitblt.search(path_info)
+        size = cache_key = None
+        if m is not None:
+            width = m.group('width')
+            height = m.group('height')
+            signature = m.group('signature')
+            if self.signatures.verify(width, height, signature):
+                try:
+                    size = parse_size(width, height)
+                except (ValueError, TypeError):
+                    raise ValueError(
+                        "Width and height parameters must be integers.")
+                if self.cache is not None:
+                    cache_key = self.url_key(
+                        path_info, self.acceptable_formats(environ))
+
+            # remove bitblt part in path info
+            environ['PATH_INFO'] = re_bitblt.sub("", path_info)
+
+        request = webob.Request(environ)
+
+        if cache_key is not None:
+            start = time.time()
+            data, entry = self.lookup(cache_key)
+            stats.since('cache.get', start)
+            if entry is not None and self.is_fresh(request, entry):
+                stats.incr('cache.hit')
+                response = make_response(*entry)
+            elif request.method == 'GET' and self.background is not None:
+                stats.incr('cache.miss')
+                response = self.background_response(
+                    request, cache_key, size, data)
+            elif request.method == 'GET':
+                stats.incr('cache.miss')
+                response = self.coalesced_response(
+                    request, cache_key, size, data)
+            else:
+                stats.incr('cache.miss')
+                response = self.transform_response(request, size, cache_key)
+        else:
+            response = self.transform_response(request, size)
+
+        if size is not None and response.status_int == 200:
+            # answer If-None-Match with 304 Not Modified
+            response.conditional_response = True
 
+        stats.since('total', stats.start)
+        self.record(stats)
         return response(environ, start_response)
 
 def make_bitblt_middleware(app, global_conf, **kwargs):
@@ -18,6 +18,15 @@ except ImportError:
     import Image
 
 class TestProfileMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dirs = []
+
+    def tearDown(self):
+        import shutil
+        for temp_dir in self._temp_dirs:
+            shutil.rmtree(temp_dir)
+
     def _makeOne(self, *arg, **kw):
         from repoze.bitblt.processor import ImageTransformationMiddleware
         return ImageTransformationMiddleware(secret='secret', *arg, **kw)
@@ -195,6 +204,171 @@ class TestProfileMiddleware(unittest.TestCase):
             '200 OK', [('Content-Type', 'text/html; charset=UTF-8'),
                        ('Content-Length', str(len(body)))]])
 
+    def test_has_rewritable_tags(self):
+        self.failIf(transform.has_rewritable_tags(''))
+        self.failIf(transform.has_rewritable_tags('<p width="640"></p>'))
+        self.failIf(transform.has_rewritable_tags(
+            '<img src="foo.png" /><img src="bar.png" /><p>640</p>'))
+        self.failUnless(transform.has_rewritable_tags(
+            '<img src="foo.png" /><img src="bar.png" width="640" />'))
+        self.failUnless(transform.has_rewritable_tags(
+            u'<img alt="a > b" src="foo.png" height=480>'))
+        # false positives are fine
+        self.failUnless(transform.has_rewritable_tags(
+            '<img src="foo.png" /><p width="640"></p>'))
+        self.failUnless(transform.ascii_compatible('utf-8'))
+        self.failUnless(transform.ascii_compatible('iso-8859-1'))
+        self.failIf(transform.ascii_compatible('utf-16'))
+        self.failIf(transform.ascii_compatible('no-such-charset'))
+
+    def test_rewrite_html_without_images(self):
+        # documents without images to rewrite are passed on as they are;
+        # this one would not even decode
+        body = '<html><body><img src="foo.png" />\xff</body></html>'
+        def mock_app(environ, start_response):
+            response = webob.Response(body, content_type='text/html')
+            return response(environ, start_response)
+        middleware = self._makeOne(mock_app)
+        response = []
+        def start_response(*args):
+            response.extend(args)
+        result = middleware(webob.Request.blank('').environ, start_response)
+        self.assertEqual(''.join(result), body)
+        self.assertEqual(response[0], '200 OK')
+
+    def test_rewrite_html_utf16(self):
+        body = u'<html><img src="foo.png" width="640" /></html>'
+        def mock_app(environ, start_response):
+            response = webob.Response(
+                body.encode('utf-16'), content_type='text/html',
+                charset='utf-16')
+            return response(environ, start_response)
+        middleware = self._makeOne(mock_app)
+        result = middleware(webob.Request.blank('').environ,
+                            lambda *args: None)
+        signature = transform.compute_signature('640', None, 'secret')
+        self.failUnless('bitblt-640xNone-%s/foo.png' % signature in
+                        ''.join(result).decode('utf-16'))
+
+    def test_rewrite_html_streaming(self):
+        body = u'''<html><body>
+            <p>\u6c49\u8bed</p>
+            <img src="foo.png" width="640" height="480" />
+            <img alt="a > b" src='bar.png' width=640 />
+            <img src="blubb.png" />
+          </body></html>'''.encode('utf-8')
+        expected = transform.rewrite_image_tags(
+            body.decode('utf-8'), 'secret').encode('utf-8')
+        self.assertNotEqual(expected, body)
+        for size in range(1, 40):
+            chunks = [body[i:i + size] for i in range(0, len(body), size)]
+            result = list(transform.rewrite_image_tags_iter(
+                chunks, 'secret', encoding='utf-8'))
+            self.assertEqual(''.join(result), expected)
+        # chunks are yielded as they come in
+        chunks = [body[:20], body[20:]]
+        result = transform.rewrite_image_tags_iter(chunks, 'secret')
+        self.assertEqual(result.next(), body[:20])
+        # also after complete tags which are not rewritten
+        for tag in ('<img>', '<img hidden src="foo.png">',
+                    '<img src="foo.png" / >'):
+            chunks = [tag + 'text', ' more text']
+            result = transform.rewrite_image_tags_iter(chunks, 'secret')
+            self.assertEqual(result.next(), chunks[0])
+        # but not before a tag is closed
+        chunks = ['<img alt="a > b" src="foo.png" ', 'width="640" />']
+        result = list(transform.rewrite_image_tags_iter(chunks, 'secret'))
+        self.assertEqual(len(result), 1)
+
+    def test_rewrite_html_streaming_middleware(self):
+        closed = []
+        body = '<html><body><img src="foo.png" width="640" /></body></html>'
+        class AppIter(object):
+            def __iter__(self):
+                return iter([body[:20], body[20:]])
+            def close(self):
+                closed.append(True)
+        def mock_app(environ, start_response):
+            start_response('200 OK', [
+                ('Content-Type', 'text/html; charset=UTF-8'),
+                ('Content-Length', str(len(body)))])
+            return AppIter()
+        middleware = self._makeOne(mock_app, stream_html='true')
+        response = []
+        def start_response(status, headers, exc_info=None):
+            response.extend([status, headers])
+        app_iter = middleware(webob.Request.blank('').environ, start_response)
+        result = ''.join(app_iter)
+        app_iter.close()
+        signature = transform.compute_signature('640', None, 'secret')
+        self.failUnless('bitblt-640xNone-%s/foo.png' % signature in result)
+        self.assertEqual(response, [
+            '200 OK', [('Content-Type', 'text/html; charset=UTF-8')]])
+        self.assertEqual(closed, [True])
+
+    def test_rewrite_html_cache(self):
+        recorded = []
+        pages = {'/a': ('<img src="foo.png" width="640" />', None),
+                 '/b': ('<img src="foo.png" width="640" />', None),
+                 '/etag': ('<img src="bar.png" width="320" />', '"1"')}
+        def mock_app(environ, start_response):
+            body, etag = pages[environ['PATH_INFO']]
+            response = webob.Response(body, content_type='text/html')
+            if etag:
+                response.headers['ETag'] = etag
+            return response(environ, start_response)
+        middleware = self._makeOne(mock_app, metrics=recorded.append,
+                                   html_cache_max_bytes='10000')
+        signature = transform.compute_signature('640', None, 'secret')
+        expected = '<img src="bitblt-640xNone-%s/foo.png" width="640" />' % (
+            signature)
+        for path in ('/a', '/a', '/b'):
+            response = webob.Request.blank(path).get_response(middleware)
+            self.assertEqual(response.body, expected)
+            self.assertEqual(response.content_length, len(expected))
+        # documents are keyed on their body, so /b shares /a's entry
+        self.assertEqual([stats.counts for stats in recorded], [
+            {'html_cache.miss': 1, 'html.rewritten': 1},
+            {'html_cache.hit': 1}, {'html_cache.hit': 1}])
+        self.assertEqual(middleware.html_cache.stats()['entries'], 1)
+
+        # with a strong ETag, the document is keyed on the URL and ETag
+        response = webob.Request.blank('/etag').get_response(middleware)
+        pages['/etag'] = ('<img src="baz.png" width="320" />', '"1"')
+        response = webob.Request.blank('/etag').get_response(middleware)
+        self.failUnless('/bar.png' in response.body)
+        pages['/etag'] = ('<img src="baz.png" width="320" />', '"2"')
+        response = webob.Request.blank('/etag').get_response(middleware)
+        self.failUnless('/baz.png' in response.body)
+        self.assertEqual(middleware.html_cache.stats()['entries'], 3)
+
+        # a different secret or application URL never shares entries
+        request = webob.Request.blank('/a')
+        key = middleware.html_key(request, request.get_response(mock_app))
+        self.assertNotEqual(key, middleware.html_key(
+            request, request.get_response(mock_app), 'http://localhost'))
+        from repoze.bitblt.processor import ImageTransformationMiddleware
+        other = ImageTransformationMiddleware(mock_app, secret='other')
+        self.assertNotEqual(key, other.html_key(
+            request, request.get_response(mock_app)))
+
+    def test_rewrite_html_cache_budget(self):
+        def mock_app(environ, start_response):
+            response = webob.Response(
+                '<img src="%s.png" width="640" />' % environ['PATH_INFO'],
+                content_type='text/html')
+            return response(environ, start_response)
+        middleware = self._makeOne(mock_app)
+        self.assertEqual(middleware.html_cache, None)
+        middleware = self._makeOne(mock_app, html_cache_max_bytes='1000',
+                                   html_cache_max_entries='10')
+        for i in range(100):
+            webob.Request.blank('/%d' % i).get_response(middleware)
+        stats = middleware.html_cache.stats()
+        self.failUnless(stats['entries'] <= 10)
+        self.failUnless(stats['bytes'] <= 1000)
+        self.assertEqual(stats['misses'], 100)
+
     def test_scaling(self):
         middleware = self._makeOne(None)
         f = middleware.process(StringIO(jpeg_image_data), (32, 32))
@@ -207,6 +381,105 @@ class TestProfileMiddleware(unittest.TestCase):
         image = Image.open(StringIO(f))
         self.assertEqual(image.size, (32, 32))
 
+    def _makeJPEG(self, size):
+        image = Image.new('RGB', (16, 16))
+        image.putdata([(x * 17, y * 17, (x * y) % 256)
+                       for y in range(16) for x in range(16)])
+        image = image.resize(size, Image.BILINEAR)
+        f = StringIO()
+        image.save(f, 'JPEG', quality=95)
+        return f.getvalue()
+
+    def test_scaling_draft(self):
+        from PIL import ImageChops
+        from PIL import ImageStat
+        data = self._makeJPEG((1600, 1200))
+        middleware = self._makeOne(None)
+        plain = self._makeOne(None, draft_factor='0')
+        for size, expected in [((100, None), (100, 75)),
+                               ((None, 60), (80, 60)),
+                               ((200, 200), (200, 150))]:
+            drafted = Image.open(StringIO(
+                middleware.process(StringIO(data), size)))
+            full = Image.open(StringIO(plain.process(StringIO(data), size)))
+            self.assertEqual(drafted.size, expected)
+            self.assertEqual(full.size, expected)
+            difference = ImageStat.Stat(ImageChops.difference(
+                drafted.convert('RGB'), full.convert('RGB')))
+            for mean in difference.mean:
+                self.failUnless(mean < 2.0, (size, difference.mean))
+
+    def test_draft_decodes_fewer_pixels(self):
+        data = self._makeJPEG((1600, 1200))
+        decoded = []
+        original_resize = Image.Image.resize
+        def resize(image, size, *args):
+            decoded.append(image.size)
+            return original_resize(image, size, *args)
+        Image.Image.resize = resize
+        try:
+            self._makeOne(None).process(StringIO(data), (100, None))
+            self._makeOne(None, draft_factor=0).process(
+                StringIO(data), (100, None))
+        finally:
+            Image.Image.resize = original_resize
+        self.assertEqual(decoded, [(200, 150), (1600, 1200)])
+
+    def test_process_many(self):
+        from PIL import ImageChops
+        from PIL import ImageStat
+        data = self._makeJPEG((1600, 1200))
+        middleware = self._makeOne(None)
+        resized = []
+        original_resize = Image.Image.resize
+        def resize(image, size, *args):
+            resized.append((image.size, size))
+            return original_resize(image, size, *args)
+        Image.Image.resize = resize
+        try:
+            bodies = middleware.process_many(
+                StringIO(data), [(100, None), (400, 400), (None, 60)])
+        finally:
+            Image.Image.resize = original_resize
+        # decoded once for the largest size, then scaled down in steps
+        self.assertEqual(resized, [((800, 600), (400, 300)),
+                                   ((400, 300), (100, 75)),
+                                   ((100, 75), (80, 60))])
+        for body, size in zip(bodies, [(100, None), (400, 400), (None, 60)]):
+            image = Image.open(StringIO(body))
+            single = Image.open(StringIO(
+                middleware.process(StringIO(data), size)))
+            self.assertEqual(image.format, 'JPEG')
+            self.assertEqual(image.size, single.size)
+            difference = ImageStat.Stat(ImageChops.difference(
+                image.convert('RGB'), single.convert('RGB')))
+            for mean in difference.mean:
+                self.failUnless(mean < 2.0, (size, difference.mean))
+        bodies = middleware.process_many(
+            StringIO(data), [(100, 100), (50, 50)], format='PNG')
+        self.assertEqual([Image.open(StringIO(body)).format
+                          for body in bodies], ['PNG', 'PNG'])
+        self.assertEqual(middleware.process_many(
+            StringIO(ico_image_data), [(5, 4), (3, 2)]),
+            [ico_image_data, ico_image_data])
+
+    def test_process_many_same_sizes(self):
+        from repoze.bitblt.processor import complete_size
+        middleware = self._makeOne(None)
+        for image_size, size in [((999, 667), (None, 500)),
+                                 ((1123, 750), (101, 67)),
+                                 ((1500, 1001), (None, 111)),
+                                 ((640, 427), (251, 90))]:
+            data = self._makeJPEG(image_size)
+            single = Image.open(StringIO(
+                middleware.process(StringIO(data), size)))
+            many = Image.open(StringIO(
+                middleware.process_many(StringIO(data), [size])[0]))
+            self.assertEqual(single.size, many.size)
+            expected = Image.new('RGB', image_size)
+            expected.thumbnail(complete_size(image_size, size))
+            self.assertEqual(many.size, expected.size)
+
     def test_dont_fail_with_ico(self):
         middleware = self._makeOne(None)
         # failed because PIL could not save ICO files
@@ -333,6 +606,301 @@ class TestProfileMiddleware(unittest.TestCase):
         self.assertEqual(headers['content-type'], 'image/jpeg')
         self.assertEqual(headers['content-length'], str(response_length))
 
+    def test_call_streams_image(self):
+        from repoze.bitblt.processor import FileIterator
+        closed = []
+        class AppIter(object):
+            def __iter__(self):
+                for i in range(0, len(jpeg_image_data), 100):
+                    yield jpeg_image_data[i:i + 100]
+            def close(self):
+                closed.append(True)
+        def mock_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'image/jpeg')])
+            return AppIter()
+        middleware = self._makeOne(mock_app, spool_threshold='1024')
+        response = self._makeImageRequest(
+            middleware.secret, 32, 32).get_response(middleware)
+        self.assertEqual(closed, [True])
+        self.failUnless(isinstance(response.app_iter, FileIterator))
+        body = ''.join(response.app_iter)
+        self.assertEqual(response.content_length, len(body))
+        self.assertEqual(Image.open(StringIO(body)).size, (32, 32))
+
+    def test_call_ico_returns_original(self):
+        def mock_app(environ, start_response):
+            response = webob.Response(
+                ico_image_data, content_type='image/x-icon')
+            return response(environ, start_response)
+        middleware = self._makeOne(mock_app)
+        response = self._makeImageRequest(
+            middleware.secret, 5, 4).get_response(middleware)
+        self.assertEqual(response.body, ico_image_data)
+
+    def test_executor(self):
+        for kind in ('thread', 'process'):
+            middleware = self._makeOne(
+                None, executor=kind, executor_workers='1')
+            try:
+                body = middleware.process(StringIO(jpeg_image_data), (32, 32))
+            finally:
+                middleware.executor.close()
+            image = Image.open(StringIO(body))
+            self.assertEqual(image.size, (32, 32))
+
+    def test_executor_busy(self):
+        import threading
+        from repoze.bitblt.concurrency import Busy
+        from repoze.bitblt.concurrency import Executor
+        def mock_app(environ, start_response):
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            return response(environ, start_response)
+        middleware = self._makeOne(mock_app)
+        middleware.executor = executor = Executor(
+            'thread', 1, max_queue=1, timeout=5)
+        try:
+            proceed = threading.Event()
+            def block():
+                try:
+                    executor.run(proceed.wait, 5)
+                except Busy:
+                    pass
+            thread = threading.Thread(target=block)
+            thread.start()
+            while not executor.pending:
+                proceed.wait(0.01)
+            response = self._makeImageRequest(middleware.secret).get_response(
+                middleware)
+            proceed.set()
+            thread.join()
+            self.assertEqual(response.status_int, 503)
+            executor.max_queue = None
+            proceed.clear()
+            thread = threading.Thread(target=block)
+            thread.start()
+            while not executor.pending:
+                proceed.wait(0.01)
+            # the worker is busy until ``proceed`` is set
+            executor.timeout = 0.01
+            response = self._makeImageRequest(middleware.secret).get_response(
+                middleware)
+            proceed.set()
+            thread.join()
+            self.assertEqual(response.status_int, 503)
+        finally:
+            executor.close()
+
+    def test_executor_timeout_stays_pending(self):
+        import threading
+        import time
+        from repoze.bitblt.concurrency import Busy
+        from repoze.bitblt.concurrency import Executor
+        executor = Executor('thread', 1, max_queue=2, timeout=0.05)
+        try:
+            proceed = threading.Event()
+            self.assertRaises(Busy, executor.run, proceed.wait, 5)
+            self.assertRaises(Busy, executor.run, proceed.wait, 5)
+            # both calls still occupy the queue
+            self.assertEqual(executor.pending, 2)
+            self.assertRaises(Busy, executor.run, proceed.wait, 5)
+            proceed.set()
+            executor.timeout = 5
+            for i in range(500):
+                if not executor.pending:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(executor.pending, 0)
+            self.assertEqual(executor.run(max, 1, 2), 2)
+            self.assertRaises(ValueError, executor.run, int, 'x')
+            self.assertEqual(executor.pending, 0)
+        finally:
+            executor.close()
+
+    def _makeBusyMiddleware(self, **kw):
+        def mock_app(environ, start_response):
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            response.headers['ETag'] = '"original"'
+            return response(environ, start_response)
+        middleware = self._makeOne(
+            mock_app, max_concurrent_resizes='1', **kw)
+        # another request is being scaled
+        self.failUnless(middleware.admission.acquire(1000))
+        return middleware
+
+    def test_overload_reject(self):
+        middleware = self._makeBusyMiddleware(retry_after='5')
+        response = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        self.assertEqual(response.status_int, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+        self.assertEqual(middleware.counts['overload.reject'], 1)
+
+    def test_overload_original(self):
+        middleware = self._makeBusyMiddleware(overload_policy='original')
+        response = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.body, jpeg_image_data)
+        self.assertEqual(response.content_length, len(jpeg_image_data))
+        self.assertEqual(response.cache_control.no_cache, '*')
+        self.assertEqual(response.etag, None)
+        self.assertEqual(middleware.counts['overload.original'], 1)
+
+    def test_overload_wait(self):
+        import threading
+        middleware = self._makeBusyMiddleware(
+            overload_policy='wait', overload_timeout='5')
+        timer = threading.Timer(0.05, middleware.admission.release, [1000])
+        timer.start()
+        response = self._makeImageRequest(
+            middleware.secret, 32, 32).get_response(middleware)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(Image.open(StringIO(response.body)).size, (32, 32))
+        self.assertEqual(middleware.counts['overload.wait'], 1)
+        self.assertEqual(middleware.admission.active, 0)
+
+        middleware = self._makeBusyMiddleware(
+            overload_policy='wait', overload_timeout='0.01')
+        response = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        self.assertEqual(response.status_int, 503)
+        self.assertEqual(
+            [(name, count) for name, count in sorted(middleware.counts.items())
+             if name.startswith('overload.')],
+            [('overload.reject', 1), ('overload.timeout', 1),
+             ('overload.wait', 1)])
+
+    def test_overload_queued_bytes(self):
+        from repoze.bitblt.concurrency import Admission
+        admission = Admission(max_bytes=100)
+        self.failUnless(admission.acquire(1000))
+        self.failIf(admission.acquire(1))
+        admission.release(1000)
+        self.failUnless(admission.acquire(60))
+        self.failUnless(admission.acquire(40))
+        self.failIf(admission.acquire(1))
+
+    def _makeBomb(self):
+        image = Image.new('1', (4000, 4000))
+        f = StringIO()
+        image.save(f, 'PNG')
+        return f.getvalue()
+
+    def test_max_pixels(self):
+        from repoze.bitblt.processor import SourceTooLarge
+        bomb = self._makeBomb()
+        opened = []
+        original_load = Image.Image.load
+        def load(image):
+            opened.append(image.size)
+            return original_load(image)
+        middleware = self._makeOne(None, max_pixels='1000000')
+        Image.Image.load = load
+        try:
+            self.assertRaises(SourceTooLarge, middleware.process,
+                              StringIO(bomb), (32, 32))
+        finally:
+            Image.Image.load = original_load
+        self.assertEqual(opened, [])
+        body = middleware.process(StringIO(jpeg_image_data), (32, 32))
+        self.assertEqual(Image.open(StringIO(body)).size, (32, 32))
+
+    def test_max_pixels_policies(self):
+        bomb = self._makeBomb()
+        def mock_app(environ, start_response):
+            response = webob.Response(bomb, content_type='image/png')
+            response.headers['ETag'] = '"original"'
+            return response(environ, start_response)
+        middleware = self._makeOne(mock_app, max_pixels='1000000')
+        response = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        self.assertEqual(response.status_int, 403)
+        self.assertEqual(middleware.admission.active, 0)
+        middleware = self._makeOne(
+            mock_app, max_pixels='1000000', oversize_policy='original')
+        response = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.body, bomb)
+        self.assertEqual(response.etag, None)
+
+    def test_bomb_header(self):
+        import struct
+        import zlib
+        from repoze.bitblt.processor import SourceTooLarge
+        # a PNG claiming 30000x30000 pixels, which Pillow itself refuses
+        f = StringIO()
+        Image.new('RGB', (4, 4)).save(f, 'PNG')
+        data = f.getvalue()
+        header = struct.pack('>II', 30000, 30000) + data[24:29]
+        bomb = data[:16] + header + struct.pack(
+            '>I', zlib.crc32('IHDR' + header) & 0xffffffff) + data[33:]
+        def mock_app(environ, start_response):
+            response = webob.Response(bomb, content_type='image/png')
+            return response(environ, start_response)
+        self.assertRaises(SourceTooLarge, self._makeOne(None).process,
+                          StringIO(bomb), (32, 32))
+        for options in [{}, dict(output_formats='webp'),
+                        dict(background='preview', cache='bitblt',
+                             cache_backend='memory')]:
+            middleware = self._makeOne(
+                mock_app, max_pixels='1000000', **options)
+            response = self._makeImageRequest(
+                middleware.secret, accept='image/webp').get_response(
+                middleware)
+            self.assertEqual(response.status_int, 403)
+            middleware = self._makeOne(
+                mock_app, max_pixels='1000000', oversize_policy='original',
+                **options)
+            response = self._makeImageRequest(
+                middleware.secret, accept='image/webp').get_response(
+                middleware)
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(response.body, bomb)
+            if middleware.background is not None:
+                self.failUnless(middleware.background.join(5))
+
+    def test_max_source_bytes(self):
+        reads = []
+        def mock_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'image/jpeg')])
+            def app_iter():
+                for i in range(0, len(jpeg_image_data), 64):
+                    reads.append(True)
+                    yield jpeg_image_data[i:i + 64]
+            return app_iter()
+        def mock_app_with_length(environ, start_response):
+            start_response('200 OK', [
+                ('Content-Type', 'image/jpeg'),
+                ('Content-Length', str(len(jpeg_image_data)))])
+            def app_iter():
+                reads.append(True)
+                yield jpeg_image_data
+            return app_iter()
+        middleware = self._makeOne(mock_app_with_length, max_source_bytes='100')
+        response = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        self.assertEqual(response.status_int, 403)
+        self.assertEqual(reads, [])
+        middleware = self._makeOne(mock_app, max_source_bytes='100')
+        response = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        self.assertEqual(response.status_int, 403)
+        # without a length, reading stops as soon as the limit is exceeded
+        self.assertEqual(len(reads), 2)
+        middleware = self._makeOne(
+            mock_app, max_source_bytes='100', oversize_policy='original')
+        response = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        self.assertEqual(response.body, jpeg_image_data)
+        middleware = self._makeOne(
+            mock_app_with_length, max_source_bytes=len(jpeg_image_data))
+        response = self._makeImageRequest(
+            middleware.secret, 32, 32).get_response(middleware)
+        self.assertEqual(Image.open(StringIO(response.body)).size, (32, 32))
+
     def test_call_no_transform_on_HEAD_removes_content_length(self):
         response = []
 
@@ -431,6 +999,92 @@ class TestProfileMiddleware(unittest.TestCase):
         middleware = self._makeOne(None, quality='10')
         f = middleware.process(StringIO(jpeg_image_data), (32, 32))
 
+    def test_encoder_profile(self):
+        from repoze.bitblt.processor import encoder_profile
+        self.assertEqual(encoder_profile(), ())
+        self.assertEqual(encoder_profile(
+            'false', 'no', ' ', '', 'off', '', 'Preserve'), ())
+        self.assertEqual(encoder_profile(
+            'true', 'yes', '4:2:0', '9', 'on', '64', 'adaptive'),
+            (('gif_palette', 'adaptive'), ('jpeg_optimize', True),
+             ('jpeg_progressive', True), ('jpeg_subsampling', '4:2:0'),
+             ('png_compress_level', 9), ('png_optimize', True),
+             ('png_quantize', 64)))
+        self.assertRaises(ValueError, encoder_profile, jpeg_subsampling='4:1:1')
+        self.assertRaises(ValueError, encoder_profile, png_compress_level='10')
+        self.assertRaises(ValueError, encoder_profile, png_quantize='1000')
+        self.assertRaises(ValueError, encoder_profile, gif_palette='web')
+        # the default profile doesn't change content keys
+        middleware = self._makeOne(None)
+        self.failIf('profile' in middleware.render_options())
+        tuned = self._makeOne(None, jpeg_progressive='true')
+        self.assertNotEqual(
+            middleware.content_key(StringIO(jpeg_image_data), (32, 32)),
+            tuned.content_key(StringIO(jpeg_image_data), (32, 32)))
+
+    def test_jpeg_profile(self):
+        data = self._makeJPEG((400, 300))
+        plain = self._makeOne(None).process(StringIO(data), (200, 150))
+        middleware = self._makeOne(None, jpeg_optimize='true',
+                                   jpeg_progressive='true',
+                                   jpeg_subsampling='4:4:4')
+        body = middleware.process(StringIO(data), (200, 150))
+        image = Image.open(StringIO(body))
+        self.assertEqual(image.size, (200, 150))
+        self.failUnless(image.info.get('progressive'))
+        self.failIf(Image.open(StringIO(plain)).info.get('progressive'))
+        # no chroma subsampling
+        self.assertEqual(image.layer[0][1:3], image.layer[1][1:3])
+        # the profile applies to images converted to JPEG as well
+        body = middleware.process(StringIO(gif_image_data), (32, 32),
+                                  format='JPEG')
+        self.failUnless(Image.open(StringIO(body)).info.get('progressive'))
+
+    def test_png_profile(self):
+        image = Image.new('RGBA', (16, 16))
+        image.putdata([(x * 17, y * 17, (x * y) % 256, x > 7 and 255 or 0)
+                       for y in range(16) for x in range(16)])
+        image = image.resize((64, 64), Image.BILINEAR)
+        f = StringIO()
+        image.save(f, 'PNG')
+        plain = self._makeOne(None).process(StringIO(f.getvalue()), (32, 32))
+        self.assertEqual(Image.open(StringIO(plain)).mode, 'RGBA')
+        middleware = self._makeOne(None, png_compress_level='9',
+                                   png_quantize='16')
+        body = middleware.process(StringIO(f.getvalue()), (32, 32))
+        image = Image.open(StringIO(body))
+        self.assertEqual(image.mode, 'P')
+        # the bit depth in the header of the PNG
+        self.assertEqual(ord(body[24]), 4)
+        self.failUnless(len(body) < len(plain), (len(body), len(plain)))
+        # transparency is kept
+        image = image.convert('RGBA')
+        self.assertEqual(image.getpixel((0, 0))[3], 0)
+        self.assertEqual(image.getpixel((31, 31))[3], 255)
+
+    def test_gif_palette(self):
+        filters = []
+        original_resize = Image.Image.resize
+        def resize(image, size, resample=Image.NEAREST, *args):
+            filters.append((image.mode, resample))
+            return original_resize(image, size, resample, *args)
+        Image.Image.resize = resize
+        try:
+            self._makeOne(None).process(StringIO(gif_image_data), (32, 32))
+            middleware = self._makeOne(None, gif_palette='adaptive')
+            body = middleware.process(StringIO(gif_image_data), (32, 32))
+            # transparent images keep their palette
+            middleware.process(StringIO(transparent_gif_image_data),
+                               (32, 32))
+        finally:
+            Image.Image.resize = original_resize
+        self.assertEqual(filters, [('P', Image.ANTIALIAS),
+                                   ('RGB', Image.ANTIALIAS),
+                                   ('P', Image.ANTIALIAS)])
+        image = Image.open(StringIO(body))
+        self.assertEqual((image.format, image.mode), ('GIF', 'P'))
+        self.assertEqual(image.size, (32, 32))
+
     def test_javascript_cdata(self):
         """Test that CDATA escaped javascript arrives unmolested when processing as XHTML."""
         body = '''\
@@ -491,6 +1145,7 @@ class TestProfileMiddleware(unittest.TestCase):
 
         import os
         import os.path
+        import shutil
         import tempfile
         temp_dir = os.path.join(tempfile.gettempdir(),
                                 'repoze.bitblt-tests-%s' % os.getpid())
@@ -518,11 +1173,764 @@ class TestProfileMiddleware(unittest.TestCase):
             middleware(request.environ, mock_start_response)
             self.assertEqual(middleware.processed, 1)
         finally:
-            for path in os.listdir(temp_dir):
-                os.remove(os.path.join(temp_dir, path))
-            os.rmdir(temp_dir)
+            shutil.rmtree(temp_dir)
             ImageTransformationMiddleware.process = ImageTransformationMiddleware._orig_process
 
+    def _makeCacheDir(self):
+        import tempfile
+        temp_dir = tempfile.mkdtemp(prefix='repoze.bitblt-tests-')
+        self._temp_dirs.append(temp_dir)
+        return temp_dir
+
+    def _makeImageRequest(self, secret, width=100, height=100, **kw):
+        signature = transform.compute_signature(width, height, secret)
+        return webob.Request.blank('bitblt-%sx%s-%s/foo.jpg' % (
+            width, height, signature), **kw)
+
+    def test_cache_hit_skips_application(self):
+        calls = []
+        def mock_app(environ, start_response):
+            calls.append(environ['REQUEST_METHOD'])
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            response.headers['Last-Modified'] = 'Mon, 01 Oct 2012 00:00:00 GMT'
+            return response(environ, start_response)
+
+        temp_dir = self._makeCacheDir()
+        middleware = self._makeOne(
+            mock_app, cache=temp_dir, revalidate='never')
+        response = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        self.assertEqual(calls, ['GET'])
+
+        cached = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        self.assertEqual(calls, ['GET'])
+        self.assertEqual(cached.body, response.body)
+        self.assertEqual(cached.content_type, 'image/jpeg')
+        self.assertEqual(cached.headers['Last-Modified'],
+                         'Mon, 01 Oct 2012 00:00:00 GMT')
+        self.assertEqual(cached.content_length, len(response.body))
+
+    def test_cache_ignores_legacy_entries(self):
+        import os
+        temp_dir = self._makeCacheDir()
+        def mock_app(environ, start_response):
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            return response(environ, start_response)
+        middleware = self._makeOne(mock_app, cache=temp_dir)
+        request = self._makeImageRequest(middleware.secret)
+        cache_key = base64.urlsafe_b64encode(request.path_info)
+        f = open(os.path.join(temp_dir, cache_key), 'wb')
+        f.write(jpeg_image_data)
+        f.close()
+        response = request.get_response(middleware)
+        image = Image.open(StringIO(response.body))
+        self.assertEqual(image.size, (48, 48))
+        self.assertEqual(response.content_type, 'image/jpeg')
+
+    def test_cache_revalidate_callback(self):
+        calls = []
+        def mock_app(environ, start_response):
+            calls.append(environ['REQUEST_METHOD'])
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            return response(environ, start_response)
+        fresh = []
+        def revalidate(environ, headers):
+            self.failIf('bitblt' in environ['PATH_INFO'])
+            self.assertEqual(dict(headers)['Content-Type'], 'image/jpeg')
+            return fresh.pop()
+
+        temp_dir = self._makeCacheDir()
+        middleware = self._makeOne(
+            mock_app, cache=temp_dir, revalidate=revalidate)
+        self._makeImageRequest(middleware.secret).get_response(middleware)
+        fresh.append(True)
+        self._makeImageRequest(middleware.secret).get_response(middleware)
+        self.assertEqual(calls, ['GET'])
+        fresh.append(False)
+        self._makeImageRequest(middleware.secret).get_response(middleware)
+        self.assertEqual(calls, ['GET', 'GET'])
+
+    def test_cache_revalidate_head(self):
+        calls = []
+        modified = ['Mon, 01 Oct 2012 00:00:00 GMT']
+        def mock_app(environ, start_response):
+            calls.append(environ['REQUEST_METHOD'])
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg',
+                conditional_response=True)
+            response.headers['Last-Modified'] = modified[0]
+            return response(environ, start_response)
+
+        temp_dir = self._makeCacheDir()
+        middleware = self._makeOne(
+            mock_app, cache=temp_dir, revalidate='head')
+        self._makeImageRequest(middleware.secret).get_response(middleware)
+        self._makeImageRequest(middleware.secret).get_response(middleware)
+        self.assertEqual(calls, ['GET', 'HEAD'])
+        # a browser revalidating its copy
+        response = self._makeImageRequest(middleware.secret, headers={
+            'If-Modified-Since': modified[0]}).get_response(middleware)
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(calls, ['GET', 'HEAD', 'HEAD'])
+        self.assertEqual(middleware.counts['cache.hit'], 2)
+        modified[0] = 'Tue, 02 Oct 2012 00:00:00 GMT'
+        self._makeImageRequest(middleware.secret).get_response(middleware)
+        self.assertEqual(calls, ['GET', 'HEAD', 'HEAD', 'HEAD', 'GET'])
+
+        # the application answers 304 whatever it is asked
+        from repoze.bitblt.processor import head_revalidator
+        def not_modified_app(environ, start_response):
+            calls.append('HEAD 304')
+            start_response('304 Not Modified', [])
+            return []
+        middleware.revalidate = head_revalidator(not_modified_app)
+        del calls[:]
+        self._makeImageRequest(middleware.secret).get_response(middleware)
+        self.assertEqual(calls, ['HEAD 304'])
+        self.assertEqual(middleware.counts['cache.hit'], 3)
+
+    def test_cache_revalidate_head_etag(self):
+        calls = []
+        etag = ['"v1"']
+        def mock_app(environ, start_response):
+            calls.append(environ['REQUEST_METHOD'])
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            response.headers['ETag'] = etag[0]
+            return response(environ, start_response)
+        middleware = self._makeOne(
+            mock_app, cache=self._makeCacheDir(), revalidate='head')
+        response = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        self.assertNotEqual(response.etag, 'v1')
+        response = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        self.failIf('X-Bitblt-Source-ETag' in response.headers)
+        self.assertEqual(calls, ['GET', 'HEAD'])
+        etag[0] = '"v2"'
+        self._makeImageRequest(middleware.secret).get_response(middleware)
+        self.assertEqual(calls, ['GET', 'HEAD', 'HEAD', 'GET'])
+
+    def test_conditional_requests(self):
+        from hashlib import sha1
+        calls = []
+        def mock_app(environ, start_response):
+            calls.append(environ['REQUEST_METHOD'])
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            response.headers['ETag'] = '"original"'
+            return response(environ, start_response)
+        for options in ({}, {'cache': 'bitblt', 'cache_backend': 'memory',
+                             'revalidate': 'never'}):
+            del calls[:]
+            middleware = self._makeOne(mock_app, **options)
+            response = self._makeImageRequest(
+                middleware.secret).get_response(middleware)
+            self.assertEqual(response.headers['ETag'],
+                             '"%s"' % sha1(response.body).hexdigest())
+            etag = response.headers['ETag']
+            response = self._makeImageRequest(
+                middleware.secret,
+                if_none_match=etag).get_response(middleware)
+            self.assertEqual(response.status_int, 304)
+            self.assertEqual(response.body, '')
+            self.assertEqual(response.headers['ETag'], etag)
+            response = self._makeImageRequest(
+                middleware.secret,
+                if_none_match='"original"').get_response(middleware)
+            self.assertEqual(response.status_int, 200)
+            # the cache answers without calling the application
+            self.assertEqual(len(calls), options and 1 or 3)
+
+    def test_max_age(self):
+        def mock_app(environ, start_response):
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['Expires'] = 'Mon, 01 Oct 2012 00:00:00 GMT'
+            return response(environ, start_response)
+        middleware = self._makeOne(mock_app)
+        response = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        middleware = self._makeOne(
+            mock_app, max_age='31536000', immutable='true', cache='bitblt',
+            cache_backend='memory')
+        for i in range(2):
+            response = self._makeImageRequest(
+                middleware.secret).get_response(middleware)
+            self.assertEqual(response.headers['Cache-Control'],
+                             'public, max-age=31536000, immutable')
+            self.failIf('Expires' in response.headers)
+        middleware = self._makeOne(mock_app, max_age='0')
+        response = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        self.assertEqual(response.headers['Cache-Control'],
+                         'public, max-age=0')
+
+    def test_content_keys(self):
+        calls = []
+        def mock_app(environ, start_response):
+            calls.append(environ['PATH_INFO'])
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            return response(environ, start_response)
+        middleware = self._makeOne(
+            mock_app, cache='bitblt', cache_backend='memory',
+            cache_keys='content', revalidate='never')
+        def get(path, width=16):
+            signature = transform.compute_signature(width, width, 'secret')
+            return webob.Request.blank('%s/bitblt-%sx%s-%s/foo.jpg' % (
+                path, width, width, signature)).get_response(middleware)
+        scaled = get('/a' * 200)
+        for path in ('/b', '/a' * 200):
+            response = get(path)
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(response.body, scaled.body)
+            self.assertEqual(response.etag, scaled.etag)
+        self.assertEqual(len(calls), 2)
+        # the image was scaled once, and is stored once
+        self.assertEqual(middleware.counts['resize.antialias'], 1)
+        self.assertEqual(middleware.counts['cache.shared'], 1)
+        self.assertEqual(len(middleware.cache.data), 3)
+        for key in middleware.cache.data:
+            self.failUnless(len(key) <= 44, key)
+        get('/b', 32)
+        self.assertEqual(middleware.counts['resize.antialias'], 2)
+        self.assertRaises(ValueError, self._makeOne, None, cache_keys='path')
+
+    def test_sibling_sizes(self):
+        from hashlib import sha1
+        calls = []
+        page = '''<html><body>
+            <img src="foo.jpg" width="32" height="32" />
+            <img src="/images/foo.jpg" width="16" />
+            <img src="http://localhost/images/foo.jpg" height="24" />
+            <img src="http://example.com/images/foo.jpg" height="8" />
+          </body></html>'''
+        def mock_app(environ, start_response):
+            calls.append(environ['PATH_INFO'])
+            if environ['PATH_INFO'].endswith('.html'):
+                response = webob.Response(page, content_type='text/html')
+            else:
+                response = webob.Response(
+                    jpeg_image_data, content_type='image/jpeg')
+            return response(environ, start_response)
+        for cache_keys in ('url', 'content'):
+            del calls[:]
+            middleware = self._makeOne(
+                mock_app, cache='bitblt', cache_backend='memory',
+                cache_keys=cache_keys, sibling_sizes='3',
+                revalidate='never')
+            webob.Request.blank('/images/page.html').get_response(middleware)
+            self.assertEqual(middleware.siblings.get('/images/foo.jpg'), [
+                ('32', '32'), ('16', None), (None, '24')])
+            def get(width, height):
+                signature = transform.compute_signature(
+                    width, height, 'secret')
+                return webob.Request.blank(
+                    '/images/bitblt-%sx%s-%s/foo.jpg' % (
+                        width, height, signature)).get_response(middleware)
+            response = get(32, 32)
+            self.assertEqual(Image.open(StringIO(response.body)).size,
+                             (32, 32))
+            # the other sizes on the page were scaled and cached along
+            self.assertEqual(middleware.counts['cache.sibling'], 2)
+            self.assertEqual(middleware.counts['resize.antialias'], 3)
+            for width, height, size in [(16, None, (16, 16)),
+                                        (None, 24, (24, 24))]:
+                sibling = get(width, height)
+                self.assertEqual(Image.open(StringIO(sibling.body)).size,
+                                 size)
+                self.assertEqual(sibling.etag.strip('"'),
+                                 sha1(sibling.body).hexdigest())
+            self.assertEqual(middleware.counts['cache.hit'], 2)
+            self.assertEqual(calls, ['/images/page.html', '/images/foo.jpg'])
+        middleware = self._makeOne(mock_app)
+        self.assertEqual(middleware.siblings, None)
+
+    def test_background(self):
+        calls = []
+        def mock_app(environ, start_response):
+            calls.append(environ['PATH_INFO'])
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            response.headers['ETag'] = '"original"'
+            response.headers['Last-Modified'] = 'Mon, 01 Oct 2012 00:00:00 GMT'
+            return response(environ, start_response)
+        for fallback in ('original', 'preview', 'redirect'):
+            del calls[:]
+            middleware = self._makeOne(
+                mock_app, cache='bitblt', cache_backend='memory',
+                background=fallback, background_workers='2',
+                preview_size='8', revalidate='never')
+            signature = transform.compute_signature(32, 32, 'secret')
+            request = webob.Request.blank(
+                '/images/bitblt-32x32-%s/foo.jpg' % signature)
+            response = request.copy().get_response(middleware)
+            self.assertEqual(response.cache_control.no_cache, '*')
+            if fallback == 'original':
+                self.assertEqual(response.body, jpeg_image_data)
+            elif fallback == 'preview':
+                self.assertEqual(Image.open(StringIO(response.body)).size,
+                                 (8, 8))
+            else:
+                self.assertEqual(response.status_int, 302)
+                self.assertEqual(response.location,
+                                 'http://localhost/images/foo.jpg')
+            # clients can't revalidate the original as the scaled image
+            self.assertEqual(response.etag, None)
+            self.assertEqual(response.last_modified, None)
+            self.failUnless(middleware.background.join(5))
+            self.assertEqual(middleware.counts['cache.miss'], 1)
+            self.assertEqual(middleware.counts['background.queued'], 1)
+            self.assertEqual(middleware.counts['resize.antialias'], 1)
+            # later requests get the scaled image from the cache
+            response = request.copy().get_response(middleware)
+            self.assertEqual(middleware.counts['cache.hit'], 1)
+            self.assertEqual(Image.open(StringIO(response.body)).size,
+                             (32, 32))
+            self.assertEqual(len(calls),
+                             fallback == 'redirect' and 1 or 2)
+        self.assertRaises(ValueError, self._makeOne, None,
+                          background='placeholder')
+
+    def test_background_preview_only_for_jpeg(self):
+        def mock_app(environ, start_response):
+            response = webob.Response(
+                gif_image_data, content_type='image/gif')
+            return response(environ, start_response)
+        middleware = self._makeOne(
+            mock_app, cache='bitblt', cache_backend='memory',
+            background='preview', preview_size='8')
+        response = self._makeImageRequest(
+            middleware.secret, 32, 32).get_response(middleware)
+        # GIF images can't be decoded at a fraction of their size
+        self.assertEqual(response.body, gif_image_data)
+        self.assertEqual(response.content_length, len(gif_image_data))
+        self.failUnless(middleware.background.join(5))
+
+    def test_background_error(self):
+        def mock_app(environ, start_response):
+            if 'bitblt' not in environ['PATH_INFO']:
+                raise RuntimeError('no image')
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            return response(environ, start_response)
+        middleware = self._makeOne(
+            mock_app, cache='bitblt', cache_backend='memory',
+            background='redirect')
+        errors = StringIO()
+        request = self._makeImageRequest(middleware.secret)
+        request.environ['wsgi.errors'] = errors
+        response = request.get_response(middleware)
+        self.assertEqual(response.status_int, 302)
+        self.failUnless(middleware.background.join(5))
+        self.assertEqual(middleware.background.counts['failed'], 1)
+        self.failUnless('RuntimeError: no image' in errors.getvalue())
+
+    def test_background_queue_full(self):
+        import threading
+        proceed = threading.Event()
+        def mock_app(environ, start_response):
+            if environ.get('HTTP_X_BLOCK'):
+                proceed.wait(5)
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            return response(environ, start_response)
+        middleware = self._makeOne(
+            mock_app, cache='bitblt', cache_backend='memory',
+            background='redirect', background_queue='1')
+        self._makeImageRequest(
+            middleware.secret, 16, 16,
+            headers={'X-Block': '1'}).get_response(middleware)
+        while middleware.background.jobs:
+            proceed.wait(0.01)
+        for i in range(2):
+            self._makeImageRequest(
+                middleware.secret, 24, 24,
+                headers={'X-Block': '1'}).get_response(middleware)
+        # the queue is full; the image is scaled while the client waits
+        response = self._makeImageRequest(
+            middleware.secret, 32, 32).get_response(middleware)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(Image.open(StringIO(response.body)).size, (32, 32))
+        self.assertEqual(middleware.counts['background.full'], 1)
+        proceed.set()
+        self.failUnless(middleware.background.join(5))
+        self.assertEqual(middleware.background.counts['duplicate'], 1)
+
+    def test_cache_regenerates_corrupt_entries(self):
+        import os
+        calls = []
+        def mock_app(environ, start_response):
+            calls.append(environ['PATH_INFO'])
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            return response(environ, start_response)
+        temp_dir = self._makeCacheDir()
+        middleware = self._makeOne(mock_app, cache=temp_dir)
+        response = self._makeImageRequest(middleware.secret).get_response(
+            middleware)
+        cache_file = [os.path.join(dirpath, name)
+                      for dirpath, dirnames, names in os.walk(temp_dir)
+                      for name in names if not name.startswith('.')][0]
+        data = open(cache_file, 'rb').read()
+        f = open(cache_file, 'wb')
+        f.write(data[:len(data) // 2])
+        f.close()
+        regenerated = self._makeImageRequest(
+            middleware.secret).get_response(middleware)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(regenerated.body, response.body)
+        self.assertEqual(open(cache_file, 'rb').read(), data)
+
+    def test_cache_miss_coalesces_threads(self):
+        import threading
+        calls = []
+        proceed = threading.Event()
+        def mock_app(environ, start_response):
+            calls.append(environ['PATH_INFO'])
+            proceed.wait(5)
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            response.set_cookie('session', 'alice')
+            return response(environ, start_response)
+        temp_dir = self._makeCacheDir()
+        middleware = self._makeOne(
+            mock_app, cache=temp_dir, revalidate='never')
+        bodies = []
+        cookies = []
+        def fetch():
+            request = self._makeImageRequest(middleware.secret)
+            response = request.get_response(middleware)
+            bodies.append(response.body)
+            cookies.extend(response.headers.getall('Set-Cookie'))
+        threads = [threading.Thread(target=fetch) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        while not calls:
+            proceed.wait(0.01)
+        # give the other threads time to join the flight
+        proceed.wait(0.1)
+        proceed.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(bodies), 5)
+        self.assertEqual(len(set(bodies)), 1)
+        self.assertEqual(Image.open(StringIO(bodies[0])).size, (48, 48))
+        # the response of one client is not passed on to the others
+        self.assertEqual(cookies, [])
+        # no lock files are left behind
+        import os
+        for dirpath, dirnames, filenames in os.walk(temp_dir):
+            for name in filenames:
+                self.failIf(name.startswith('.lock-'), name)
+
+    def _fetchCoalesced(self, middleware, calls, proceed, first, others):
+        # ``first`` leads the flight, ``others`` join it while the
+        # application is blocked on ``proceed``
+        import threading
+        requests = [first] + others
+        responses = [None] * len(requests)
+        def fetch(i):
+            responses[i] = requests[i].get_response(middleware)
+        threads = [threading.Thread(target=fetch, args=(i,))
+                   for i in range(len(requests))]
+        threads[0].start()
+        while not calls:
+            proceed.wait(0.01)
+        for thread in threads[1:]:
+            thread.start()
+        # give the other threads time to join the flight
+        proceed.wait(0.1)
+        proceed.set()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def test_cache_miss_coalesces_conditional_requests(self):
+        import threading
+        calls = []
+        proceed = threading.Event()
+        def mock_app(environ, start_response):
+            calls.append(environ.get('HTTP_IF_MODIFIED_SINCE'))
+            proceed.wait(5)
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg',
+                conditional_response=True)
+            response.headers['Last-Modified'] = 'Mon, 01 Oct 2012 00:00:00 GMT'
+            return response(environ, start_response)
+        middleware = self._makeOne(
+            mock_app, cache='bitblt', cache_backend='memory',
+            revalidate='never')
+        first = self._makeImageRequest(middleware.secret, headers={
+            'If-Modified-Since': 'Tue, 02 Oct 2012 00:00:00 GMT'})
+        others = [self._makeImageRequest(middleware.secret)
+                  for i in range(3)]
+        responses = self._fetchCoalesced(
+            middleware, calls, proceed, first, others)
+        # the original is fetched once, without the conditional header
+        self.assertEqual(calls, [None])
+        self.assertEqual(responses[0].status_int, 304)
+        for response in responses[1:]:
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(Image.open(StringIO(response.body)).size,
+                             (48, 48))
+        self.assertEqual(middleware.cache.stats()['sets'], 1)
+
+    def test_cache_miss_shares_only_success(self):
+        import threading
+        calls = []
+        proceed = threading.Event()
+        def mock_app(environ, start_response):
+            calls.append(environ['PATH_INFO'])
+            proceed.wait(5)
+            if len(calls) == 1:
+                response = webob.Response('Oops', status=500)
+            else:
+                response = webob.Response(
+                    jpeg_image_data, content_type='image/jpeg')
+            return response(environ, start_response)
+        middleware = self._makeOne(
+            mock_app, cache='bitblt', cache_backend='memory',
+            revalidate='never')
+        responses = self._fetchCoalesced(
+            middleware, calls, proceed,
+            self._makeImageRequest(middleware.secret),
+            [self._makeImageRequest(middleware.secret) for i in range(2)])
+        self.assertEqual([response.status_int for response in responses],
+                         [500, 200, 200])
+        # the waiters fetched the original themselves, one at a time
+        self.assertEqual(len(calls), 2)
+
+    def test_cache_keeps_access_control(self):
+        import threading
+        calls = []
+        proceed = threading.Event()
+        def mock_app(environ, start_response):
+            authorized = 'HTTP_AUTHORIZATION' in environ
+            calls.append((environ['REQUEST_METHOD'], authorized))
+            if not authorized:
+                return webob.Response(status=403)(environ, start_response)
+            proceed.wait(5)
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            return response(environ, start_response)
+        middleware = self._makeOne(
+            mock_app, cache='bitblt', cache_backend='memory')
+        def request(authorized):
+            headers = authorized and {'Authorization': 'Basic x'} or {}
+            return self._makeImageRequest(middleware.secret, headers=headers)
+        # a client which may not see the original doesn't get it from
+        # another client's flight
+        responses = self._fetchCoalesced(
+            middleware, calls, proceed, request(True), [request(False)])
+        self.assertEqual([response.status_int for response in responses],
+                         [200, 403])
+        # nor from the cache
+        del calls[:]
+        self.assertEqual(request(False).get_response(middleware).status_int,
+                         403)
+        self.assertEqual(calls, [('HEAD', False), ('GET', False)])
+        del calls[:]
+        self.assertEqual(request(True).get_response(middleware).status_int,
+                         200)
+        self.assertEqual(calls, [('HEAD', True)])
+
+    def test_cache_miss_waits_for_other_process(self):
+        import threading
+        from repoze.bitblt.cache import dump_entry
+        calls = []
+        def mock_app(environ, start_response):
+            calls.append(environ['PATH_INFO'])
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            return response(environ, start_response)
+        temp_dir = self._makeCacheDir()
+        middleware = self._makeOne(
+            mock_app, cache=temp_dir, revalidate='never')
+        request = self._makeImageRequest(middleware.secret)
+        cache_key = base64.urlsafe_b64encode(request.path_info)
+        # another process is rendering the image
+        lock = middleware.cache.lock(cache_key)
+        self.failUnless(lock.acquire())
+        responses = []
+        def fetch():
+            responses.append(request.get_response(middleware))
+        thread = threading.Thread(target=fetch)
+        thread.start()
+        thread.join(0.1)
+        self.failUnless(thread.isAlive())
+        middleware.cache.set(cache_key, dump_entry(
+            [('Content-Type', 'image/png')], 'rendered elsewhere'))
+        lock.release()
+        thread.join()
+        self.assertEqual(calls, [])
+        self.assertEqual(responses[0].body, 'rendered elsewhere')
+        self.assertEqual(responses[0].content_type, 'image/png')
+
+    def test_revalidate_dotted_name(self):
+        from repoze.bitblt.processor import resolve
+        middleware = self._makeOne(
+            None, revalidate='repoze.bitblt.processor:resolve')
+        self.assertEqual(middleware.revalidate, resolve)
+        middleware = self._makeOne(None, revalidate='never')
+        self.assertEqual(middleware.revalidate, None)
+        # HEAD requests by default
+        middleware = self._makeOne(None, revalidate='')
+        self.assertEqual(middleware.revalidate.__name__, 'revalidate')
+
+    def test_accepted_types(self):
+        from repoze.bitblt.processor import accepted_types
+        self.assertEqual(accepted_types(None), set())
+        self.assertEqual(
+            accepted_types('image/avif,image/webp,image/apng,image/*,*/*;q=0.8'),
+            set(['image/avif', 'image/webp', 'image/apng']))
+        self.assertEqual(
+            accepted_types('Image/WebP; q=0.5, image/png;q=0, image/jpeg;q=x'),
+            set(['image/webp']))
+
+    def test_output_format(self):
+        from repoze.bitblt.processor import output_format
+        def make(mode, format, **info):
+            image = Image.new(mode, (4, 4))
+            image.format = format
+            image.info.update(info)
+            return image
+        self.assertEqual(output_format(
+            make('RGB', 'PNG'), ('WEBP', 'JPEG')), 'WEBP')
+        self.assertEqual(output_format(make('RGB', 'PNG'), ('JPEG',)), 'JPEG')
+        # transparency is kept
+        self.assertEqual(output_format(make('RGBA', 'PNG'), ('JPEG',)), None)
+        self.assertEqual(output_format(
+            make('P', 'GIF', transparency=0), ('JPEG', 'WEBP')), 'WEBP')
+        # the original format is preferred
+        self.assertEqual(output_format(
+            make('RGB', 'JPEG'), ('JPEG', 'WEBP')), None)
+        self.assertEqual(output_format(make('RGB', 'ICO'), ('WEBP',)), None)
+        image = make('P', 'GIF')
+        image.is_animated = True
+        self.assertEqual(output_format(image, ('WEBP',)), None)
+
+    def test_output_formats(self):
+        image = Image.new('RGB', (64, 64), (255, 0, 0))
+        f = StringIO()
+        image.save(f, 'PNG')
+        def mock_app(environ, start_response):
+            response = webob.Response(f.getvalue(), content_type='image/png')
+            return response(environ, start_response)
+        middleware = self._makeOne(
+            mock_app, output_formats='webp, nonsense', cache='bitblt',
+            cache_backend='memory')
+        self.assertEqual(middleware.output_formats, ('WEBP',))
+        for i in range(2):
+            response = self._makeImageRequest(
+                middleware.secret, 16, 16,
+                accept='image/webp,*/*').get_response(middleware)
+            self.assertEqual(response.content_type, 'image/webp')
+            self.assertEqual(response.vary, ('Accept',))
+            self.assertEqual(Image.open(StringIO(response.body)).format,
+                             'WEBP')
+            response = self._makeImageRequest(
+                middleware.secret, 16, 16,
+                accept='*/*').get_response(middleware)
+            self.assertEqual(response.content_type, 'image/png')
+            self.assertEqual(response.vary, ('Accept',))
+            self.assertEqual(Image.open(StringIO(response.body)).format, 'PNG')
+        # each format is cached separately
+        self.assertEqual(len(middleware.cache.data), 2)
+        self.assertEqual(middleware.counts['cache.hit'], 2)
+
+    def test_metrics(self):
+        def mock_app(environ, start_response):
+            response = webob.Response(
+                jpeg_image_data, content_type='image/jpeg')
+            return response(environ, start_response)
+        recorded = []
+        middleware = self._makeOne(
+            mock_app, cache='bitblt', cache_backend='memory',
+            metrics=recorded.append)
+        self.assertEqual(middleware.cache_hit_ratio(), None)
+        for i in range(2):
+            request = self._makeImageRequest(middleware.secret, 16, 16)
+            response = request.get_response(middleware)
+            self.assertEqual(response.status_int, 200)
+            self.failUnless(request.environ['repoze.bitblt.stats']
+                            is recorded[-1])
+        miss, hit = recorded
+        self.assertEqual(miss.counts, {
+            'cache.miss': 1, 'resize.antialias': 1,
+            'bytes.in': len(jpeg_image_data),
+            'bytes.out': len(response.body)})
+        for name in ('cache.get', 'app', 'decode', 'resize', 'encode',
+                     'cache.set', 'total'):
+            self.failUnless(miss.timings[name] >= 0, name)
+        self.assertEqual(hit.counts, {'cache.hit': 1})
+        self.assertEqual(sorted(hit.timings), ['cache.get', 'total'])
+        self.assertEqual(middleware.counts['resize.antialias'], 1)
+        self.assertEqual(middleware.cache_hit_ratio(), 0.5)
+
+    def test_metrics_html(self):
+        recorded = []
+        def mock_app(environ, start_response):
+            response = webob.Response(
+                environ['PATH_INFO'] == '/plain' and '<p>plain</p>' or
+                '<img src="foo.png" width="640" />', content_type='text/html')
+            return response(environ, start_response)
+        middleware = self._makeOne(mock_app, metrics=recorded.append)
+        webob.Request.blank('/plain').get_response(middleware)
+        webob.Request.blank('/images').get_response(middleware)
+        self.assertEqual(recorded[0].counts, {'html.skipped': 1})
+        self.assertEqual(recorded[1].counts, {'html.rewritten': 1})
+        self.failUnless('rewrite' in recorded[1].timings)
+
+    def test_metrics_configuration(self):
+        from repoze.bitblt.metrics import StatsdClient
+        middleware = self._makeOne(
+            None, metrics='statsd', statsd_host='127.0.0.1',
+            statsd_port='8126', statsd_prefix='images')
+        self.failUnless(isinstance(middleware.metrics, StatsdClient))
+        self.assertEqual(middleware.metrics.address, ('127.0.0.1', 8126))
+        self.assertEqual(middleware.metrics.prefix, 'images.')
+        middleware = self._makeOne(
+            None, metrics='repoze.bitblt.processor:resolve')
+        from repoze.bitblt.processor import resolve
+        self.assertEqual(middleware.metrics, resolve)
+        middleware = self._makeOne(None, metrics=' ')
+        self.assertEqual(middleware.metrics, None)
+
+    def test_metrics_statsd(self):
+        import socket
+        from repoze.bitblt.metrics import Stats
+        from repoze.bitblt.metrics import StatsdClient
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            server.bind(('127.0.0.1', 0))
+            server.settimeout(5)
+            client = StatsdClient(*server.getsockname())
+            stats = Stats()
+            stats.timing('resize', 0.25)
+            stats.incr('cache.miss')
+            stats.incr('bytes.out', 1234)
+            client(stats)
+            self.assertEqual(server.recv(client.max_packet).split('\n'), [
+                'bitblt.resize:250|ms', 'bitblt.bytes.out:1234|c',
+                'bitblt.cache.miss:1|c'])
+            # long reports are split into several packets
+            client.max_packet = 30
+            client(stats)
+            self.assertEqual(server.recv(512), 'bitblt.resize:250|ms')
+            self.assertEqual(server.recv(512), 'bitblt.bytes.out:1234|c')
+            self.assertEqual(server.recv(512), 'bitblt.cache.miss:1|c')
+        finally:
+            server.close()
+
 
 class TestImgMatch(unittest.TestCase):
 
@@ -589,6 +1997,796 @@ class TestImgMatch(unittest.TestCase):
             '<img src=foo.png width=640 fb:name=bobo height=480 />',
             ('foo.png', '480', '640'))
 
+class TestImgScanner(TestImgMatch):
+
+    def match(self, tag, app_url=None):
+        matches = [match for match in transform.iter_image_tags(tag)
+                   if match.start() == 0]
+        if not matches:
+            return None
+        match = matches[0]
+        result = transform.parse_regex_match(match, app_url=app_url)
+        if result is None:
+            return None
+        src, height, width, scheme, netloc, path, params, query, fragment = result
+        return src, height, width
+
+    def test_same_as_re_img(self):
+        import random
+        rnd = random.Random(0)
+        values = ['foo.png', '/a/b.png', '', '640', '480px', '50%', 'x y']
+        names = ['src', 'width', 'height', 'alt', 'fb:name']
+        quotes = ['"', "'", '']
+        ends = ['>', '/>', ' />', '\n>', '', ' <p>']
+        for i in range(3000):
+            attributes = []
+            for j in range(rnd.randint(0, 4)):
+                value = rnd.choice(values)
+                quote = rnd.choice(quotes)
+                if not quote:
+                    value = value.replace(' ', '')
+                attributes.append(' %s=%s%s%s' % (
+                    rnd.choice(names), quote, value, quote))
+            tag = '<img%s%s' % (''.join(attributes), rnd.choice(ends))
+            old = transform.re_img.match(tag)
+            new = transform.re_img_tag.match(tag)
+            if old is None:
+                self.failUnless(new is None, tag)
+            else:
+                self.failIf(new is None, tag)
+                self.assertEqual(new.group(0), old.group(0))
+                self.assertEqual(new.groupdict(), old.groupdict())
+
+    def test_iter_same_as_re_img(self):
+        import random
+        rnd = random.Random(0)
+        values = ['foo.png', '/a/b.png', '', '640', '480px', '50%', 'x y']
+        names = ['src', 'width', 'height', 'alt', 'fb:name']
+        quotes = ['"', "'", '']
+        ends = ['>', '/>', ' />', '']
+        for i in range(300):
+            tags = []
+            for j in range(3):
+                attributes = []
+                for k in range(rnd.randint(0, 11)):
+                    value = rnd.choice(values)
+                    quote = rnd.choice(quotes)
+                    if not quote:
+                        value = value.replace(' ', '')
+                    attributes.append(' %s=%s%s%s' % (
+                        rnd.choice(names), quote, value, quote))
+                tags.append('<img%s%s' % (''.join(attributes),
+                                           rnd.choice(ends)))
+            body = '\n'.join(tags)
+            self.assertEqual(
+                [(mo.span(), mo.groupdict())
+                 for mo in transform.iter_image_tags(body)],
+                [(mo.span(), mo.groupdict())
+                 for mo in transform.re_img.finditer(body)])
+
+    def test_long_tags(self):
+        tag = '<img src="foo.png" width="640"%s />' % (
+            ' data:x="1"' * 10)
+        body = '<p>%s<img src="bar.png" height="48" />%s</p>' % (tag, tag)
+        result = transform.rewrite_image_tags(body, 'secret')
+        self.assertEqual(result.count('bitblt-640xNone-'), 2)
+        self.assertEqual(result.count('bitblt-Nonex48-'), 1)
+
+    def test_long_tags_differ_from_re_img(self):
+        # the intended differences on malformed markup, which only
+        # show in tags of more than 8 attributes
+        for tag, short, long in [
+            ('<img src="foo.png" width=10"%s>', ('foo.png', None, '10'),
+             None),
+            ('<img width=640 src=a>b%s>', ('a>b', None, '640'),
+             ('a', None, '640')),
+            ('<img width="640" src="a>b"%s>', ('a>b', None, '640'),
+             ('a', None, '640')),
+            ]:
+            for attributes, expected in ((6, short), (8, long)):
+                markup = tag % (' alt=x' * attributes)
+                self.assertEqual(
+                    TestImgMatch.match(self, markup), short)
+                self.assertEqual(self.match(markup), expected)
+
+    def test_linear_time(self):
+        import time
+        tag = '<img%s data-x=1' % (' src=a' * 20000)
+        start = time.time()
+        self.assertEqual(transform.re_img_tag.match(tag), None)
+        body = '\n'.join(['<img%s hidden>' % (' src=a' * 20)] * 1000)
+        self.assertEqual(list(transform.iter_image_tags(tag + body)), [])
+        self.failUnless(time.time() - start < 5)
+
+class TestSignatureCache(unittest.TestCase):
+
+    def _makeOne(self, max_entries=1024):
+        return transform.SignatureCache('secret', max_entries)
+
+    def test_signature(self):
+        signatures = self._makeOne()
+        self.assertEqual(signatures('640', '480'),
+                         transform.compute_signature('640', '480', 'secret'))
+        self.assertEqual(signatures(None, '480'),
+                         transform.compute_signature(None, '480', 'secret'))
+        self.assertEqual(len(signatures.signatures), 2)
+
+    def test_memoized(self):
+        signatures = self._makeOne()
+        signatures.signatures[('640', '480')] = 'remembered'
+        self.assertEqual(signatures('640', '480'), 'remembered')
+
+    def test_bounded(self):
+        signatures = self._makeOne(max_entries=2)
+        for width in ('1', '2', '3'):
+            signatures(width, '480')
+        self.assertEqual(signatures.signatures.keys(), [('3', '480')])
+
+    def test_verify(self):
+        signatures = self._makeOne()
+        signature = transform.compute_signature('640', '480', 'secret')
+        self.failUnless(signatures.verify('640', '480', signature))
+        self.failIf(signatures.verify('640', '481', signature))
+        self.failIf(signatures.verify('640', '480', 'forged'))
+
+class TestConcurrency(unittest.TestCase):
+
+    def test_file_lock(self):
+        import os
+        import shutil
+        import tempfile
+        from repoze.bitblt.concurrency import FileLock
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'lock')
+            first, second = FileLock(path), FileLock(path)
+            self.failUnless(first.acquire())
+            self.failIf(second.acquire(timeout=0.05))
+            first.release()
+            self.failIf(os.path.exists(path))
+            self.failUnless(second.acquire(timeout=0.05))
+            second.release()
+            self.failIf(os.path.exists(path))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_file_lock_removed_while_waiting(self):
+        import os
+        import shutil
+        import tempfile
+        import threading
+        from repoze.bitblt.concurrency import FileLock
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'lock')
+            first, second, third = (
+                FileLock(path), FileLock(path), FileLock(path))
+            self.failUnless(first.acquire())
+            acquired = []
+            thread = threading.Thread(
+                target=lambda: acquired.append(second.acquire(timeout=5)))
+            thread.start()
+            # let the second lock open the file before it is removed
+            thread.join(0.1)
+            first.release()
+            thread.join()
+            self.assertEqual(acquired, [True])
+            # the second lock holds the file which is there now
+            self.failIf(third.acquire(timeout=0.05))
+            second.release()
+            self.failUnless(third.acquire(timeout=0.05))
+            third.release()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_single_flight_shares_result(self):
+        import threading
+        from repoze.bitblt.concurrency import SingleFlight
+        flight = SingleFlight()
+        started = threading.Event()
+        proceed = threading.Event()
+        calls = []
+        def work():
+            calls.append(1)
+            started.set()
+            proceed.wait(5)
+            return 'result'
+        results = []
+        def run():
+            results.append(flight.do('key', work))
+        threads = [threading.Thread(target=run) for i in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        proceed.wait(0.1)
+        proceed.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['result'] * 4)
+        self.assertEqual(flight.calls, {})
+
+    def test_single_flight_shares_errors(self):
+        import threading
+        from repoze.bitblt.concurrency import SingleFlight
+        flight = SingleFlight()
+        started = threading.Event()
+        proceed = threading.Event()
+        def work():
+            started.set()
+            proceed.wait(5)
+            raise KeyError('boom')
+        errors = []
+        def run():
+            try:
+                flight.do('key', work)
+            except KeyError:
+                errors.append(1)
+        threads = [threading.Thread(target=run) for i in range(2)]
+        threads[0].start()
+        started.wait(5)
+        threads[1].start()
+        proceed.wait(0.1)
+        proceed.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [1, 1])
+
+    def test_background_queue(self):
+        import threading
+        from repoze.bitblt.concurrency import BackgroundQueue
+        queue = BackgroundQueue(workers=1, max_queue=2)
+        proceed = threading.Event()
+        calls = []
+        def work(name):
+            proceed.wait(5)
+            calls.append(name)
+        self.failUnless(queue.submit('a', work, 'a'))
+        # wait for the worker to take the first call off the queue
+        while queue.jobs:
+            proceed.wait(0.01)
+        self.failUnless(queue.submit('b', work, 'b'))
+        self.failUnless(queue.submit('b', work, 'b'))
+        self.failUnless(queue.submit('c', work, 'c'))
+        self.failIf(queue.submit('d', work, 'd'))
+        self.failIf(queue.join(0.01))
+        proceed.set()
+        self.failUnless(queue.join(5))
+        self.assertEqual(calls, ['a', 'b', 'c'])
+        self.assertEqual(queue.counts, dict(
+            queued=3, duplicate=1, full=1, done=3, failed=0))
+        # without deduplication, every call is queued
+        queue = BackgroundQueue(dedupe=False)
+        for i in range(3):
+            queue.submit('a', work, 'a')
+        self.failUnless(queue.join(5))
+        self.assertEqual(calls, ['a', 'b', 'c', 'a', 'a', 'a'])
+
+class MemcachedStandIn(object):
+    """A minimal memcached speaking the text protocol for tests."""
+
+    def __init__(self):
+        import SocketServer
+        import threading
+        data = self.data = {}
+        commands = self.commands = []
+        self.meta = True
+        standin = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    parts = line.split()
+                    commands.append(parts[0])
+                    if parts[0] == 'mg' and standin.meta:
+                        if parts[1] in data:
+                            self.wfile.write('HD\r\n')
+                        else:
+                            self.wfile.write('EN\r\n')
+                    elif parts[0] == 'get':
+                        value = data.get(parts[1])
+                        if value is not None:
+                            self.wfile.write('VALUE %s 0 %d\r\n%s\r\n' % (
+                                parts[1], len(value), value))
+                        self.wfile.write('END\r\n')
+                    elif parts[0] == 'set':
+                        value = self.rfile.read(int(parts[4]) + 2)[:-2]
+                        data[parts[1]] = value
+                        self.wfile.write('STORED\r\n')
+                    elif parts[0] == 'delete':
+                        if data.pop(parts[1], None) is None:
+                            self.wfile.write('NOT_FOUND\r\n')
+                        else:
+                            self.wfile.write('DELETED\r\n')
+                    else:
+                        self.wfile.write('ERROR\r\n')
+
+        class Server(SocketServer.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.address = '127.0.0.1:%d' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class TestCacheBackends(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dirs = []
+
+    def tearDown(self):
+        import shutil
+        for temp_dir in self._temp_dirs:
+            shutil.rmtree(temp_dir)
+
+    def _checkBackend(self, cache):
+        self.assertEqual(cache.get('foo'), None)
+        self.failIf(cache.has('foo'))
+        cache.set('foo', 'bar\r\nbaz')
+        self.assertEqual(cache.get('foo'), 'bar\r\nbaz')
+        cache.set('foo', 'qux')
+        self.assertEqual(cache.get('foo'), 'qux')
+        self.failUnless(cache.has('foo'))
+        cache.delete('foo')
+        cache.delete('foo')
+        self.assertEqual(cache.get('foo'), None)
+        self.failIf(cache.has('foo'))
+        # has is not counted
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['sets'], 2)
+        self.assertEqual(stats['deletes'], 1)
+
+    def test_filesystem(self):
+        import shutil
+        import tempfile
+        from repoze.bitblt.cache import FileSystemCache
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self._checkBackend(FileSystemCache(temp_dir))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_entries(self):
+        from repoze.bitblt.cache import dump_entry
+        from repoze.bitblt.cache import load_entry
+        headers = [('Content-Type', 'image/png'), ('ETag', '"x"')]
+        data = dump_entry(headers, 'body\r\n\r\nmore')
+        self.assertEqual(load_entry(data),
+                         (headers, 'body\r\n\r\nmore'))
+        self.assertEqual(load_entry(dump_entry([], '')), ([], ''))
+        self.assertEqual(load_entry(data[:-1]), None)
+        self.assertEqual(load_entry(data[:-1] + 'x'), None)
+        self.assertEqual(load_entry(data + 'x'), None)
+        self.assertEqual(load_entry(jpeg_image_data), None)
+        self.assertEqual(load_entry(''), None)
+
+    def test_filesystem_atomic_writes(self):
+        import os
+        import threading
+        from repoze.bitblt.cache import FileSystemCache
+        temp_dir = self._makeDir()
+        cache = FileSystemCache(temp_dir)
+        values = ['a' * 100000, 'b' * 200000]
+        seen = []
+        def write():
+            for i in range(50):
+                cache.set('key', values[i % 2])
+        def read():
+            for i in range(200):
+                value = cache.get('key')
+                if value is not None:
+                    seen.append(value in values)
+        threads = [threading.Thread(target=write) for i in range(2)]
+        threads.extend([threading.Thread(target=read) for i in range(2)])
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.failUnless(seen)
+        self.failUnless(all(seen))
+        self.assertEqual(self._listFiles(temp_dir), [cache.path('key')])
+
+    def test_filesystem_removes_stale_temporary_files(self):
+        import os
+        import time
+        from repoze.bitblt.cache import FileSystemCache
+        temp_dir = self._makeDir()
+        cache = FileSystemCache(temp_dir, max_entries=10)
+        for name in ('.tmp-stale', '.tmp-fresh'):
+            open(os.path.join(temp_dir, name), 'wb').close()
+        past = time.time() - 2 * cache.temp_max_age
+        os.utime(os.path.join(temp_dir, '.tmp-stale'), (past, past))
+        cache.scan()
+        self.assertEqual(os.listdir(temp_dir), ['.tmp-fresh'])
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_memory(self):
+        from repoze.bitblt.cache import MemoryCache
+        self._checkBackend(MemoryCache())
+
+    def test_memory_lru(self):
+        from repoze.bitblt.cache import MemoryCache
+        cache = MemoryCache(max_entries=10)
+        for i in range(10):
+            cache.set(str(i), 'x')
+        cache.get('0')
+        cache.set('10', 'x')
+        self.assertEqual(cache.stats()['entries'], 9)
+        self.assertEqual(cache.get('0'), 'x')
+        self.assertEqual(cache.get('1'), None)
+        self.assertEqual(cache.get('10'), 'x')
+
+    def test_memory_max_bytes(self):
+        from repoze.bitblt.cache import MemoryCache
+        cache = MemoryCache(max_entries=None, max_bytes='100')
+        for i in range(20):
+            cache.set(str(i), 'x' * 10)
+        self.failUnless(cache.stats()['bytes'] <= 100)
+        self.assertEqual(cache.get('19'), 'x' * 10)
+
+    def test_memory_lfu(self):
+        from repoze.bitblt.cache import MemoryCache
+        cache = MemoryCache(max_entries=10, eviction='lfu')
+        for i in range(10):
+            cache.set(str(i), 'x')
+            if i:
+                cache.get(str(i))
+        cache.set('10', 'x')
+        cache.get('10')
+        self.assertEqual(cache.get('0'), None)
+        self.assertEqual(cache.get('1'), 'x')
+        self.assertRaises(ValueError, MemoryCache, eviction='bogus')
+
+    def _makeDir(self):
+        import tempfile
+        temp_dir = tempfile.mkdtemp()
+        self._temp_dirs.append(temp_dir)
+        return temp_dir
+
+    def _listFiles(self, directory):
+        import os
+        return sorted([os.path.join(dirpath, name)
+                       for dirpath, dirnames, names in os.walk(directory)
+                       for name in names])
+
+    def _writeFile(self, path, data='x'):
+        import os
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+
+    def test_filesystem_levels(self):
+        import os
+        from repoze.bitblt.cache import FileSystemCache
+        temp_dir = self._makeDir()
+        cache = FileSystemCache(temp_dir)
+        cache.set('key', 'x')
+        path = cache.path('key')
+        self.assertEqual(os.path.relpath(path, temp_dir).split(os.sep)[2:],
+                         ['key'])
+        self.assertEqual(open(path).read(), 'x')
+        self.assertEqual(FileSystemCache(temp_dir, levels=3).get('key'), None)
+        self.assertEqual(FileSystemCache(temp_dir, levels=0).path('key'),
+                         os.path.join(temp_dir, 'key'))
+        # keys which are too long for a file name are hashed
+        key = 'k' * 1000
+        cache.set(key, 'long')
+        self.assertEqual(cache.get(key), 'long')
+        self.failUnless(len(os.path.basename(cache.path(key))) < 50)
+        # the index holds file names
+        cache = FileSystemCache(temp_dir, max_entries=1)
+        self.assertEqual(cache.stats()['entries'], 0)
+        cache.scan()
+        cache.set(key, 'long')
+        cache.set('key', 'x')
+        self.assertEqual(cache.get(key), None)
+        self.assertEqual(self._listFiles(temp_dir), [cache.path('key')])
+
+    def test_filesystem_migrate(self):
+        import os
+        from repoze.bitblt.cache import FileSystemCache
+        from repoze.bitblt.cache import migrate_main
+        temp_dir = self._makeDir()
+        flat = FileSystemCache(temp_dir, levels=0)
+        for i in range(10):
+            flat.set(str(i), str(i))
+        self._writeFile(os.path.join(temp_dir, '.lock-foo'))
+        out = StringIO()
+        self.assertEqual(migrate_main([temp_dir], out), 0)
+        self.assertEqual(out.getvalue(), '10 files moved.\n')
+        cache = FileSystemCache(temp_dir, max_entries=100)
+        self.assertEqual(cache.get('3'), '3')
+        cache.scanner.join()
+        self.assertEqual(cache.stats()['entries'], 10)
+        self.assertEqual(cache.migrate(), 0)
+        self.failUnless(os.path.exists(os.path.join(temp_dir, '.lock-foo')))
+        # and back again; empty directories are removed
+        self.assertEqual(flat.migrate(), 10)
+        self.assertEqual(sorted(os.listdir(temp_dir)), ['.lock-foo'] + [
+            str(i) for i in range(10)])
+
+    def test_filesystem_eviction(self):
+        import os
+        from repoze.bitblt.cache import FileSystemCache
+        temp_dir = self._makeDir()
+        cache = FileSystemCache(temp_dir, max_bytes='1000')
+        cache.scan()
+        for i in range(10):
+            cache.set(str(i), 'x' * 100)
+        cache.get('0')
+        # has doesn't count as a use
+        self.failUnless(cache.has('1'))
+        cache.set('10', 'x' * 100)
+        self.assertEqual(len(self._listFiles(temp_dir)), 9)
+        self.assertEqual(cache.stats()['bytes'], 900)
+        self.assertEqual(cache.stats()['evictions'], 2)
+        self.assertEqual(cache.get('0'), 'x' * 100)
+        self.assertEqual(cache.get('1'), None)
+        self.assertEqual(cache.get('2'), None)
+
+    def test_filesystem_eviction_is_amortized(self):
+        import os
+        from repoze.bitblt.cache import FileSystemCache
+        temp_dir = self._makeDir()
+        cache = FileSystemCache(temp_dir, max_entries=10)
+        for i in range(100):
+            self._writeFile(cache.path(str(i)))
+        cache.scan()
+        cache.compact_batch = 5
+        cache.set('new', 'x')
+        self.assertEqual(len(self._listFiles(temp_dir)), 96)
+        self.assertEqual(cache.get('new'), 'x')
+        cache.compact()
+        self.assertEqual(len(self._listFiles(temp_dir)), 9)
+        self.assertEqual(cache.get('new'), 'x')
+
+    def test_filesystem_rescan(self):
+        import os
+        from repoze.bitblt.cache import FileSystemCache
+        temp_dir = self._makeDir()
+        cache = FileSystemCache(temp_dir, max_entries=10)
+        other = FileSystemCache(temp_dir, max_entries=10)
+        cache.set('foo', 'x')
+        cache.scanner.join()
+        other.set('bar', 'x')
+        self.assertEqual(cache.stats()['entries'], 1)
+        cache.rescan_interval = 0
+        cache.get('foo')
+        cache.scanner.join()
+        self.assertEqual(cache.stats()['entries'], 2)
+        os.remove(cache.path('foo'))
+        cache.rescan_interval = 3600
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.stats()['entries'], 1)
+
+    def test_filesystem_scan_in_background(self):
+        import threading
+        from repoze.bitblt.cache import FileSystemCache
+        temp_dir = self._makeDir()
+        cache = FileSystemCache(temp_dir, max_entries=10, rescan_interval=0)
+        for i in range(3):
+            self._writeFile(cache.path(str(i)))
+        walking = threading.Event()
+        proceed = threading.Event()
+        files = cache.files
+        def blocking_files():
+            walking.set()
+            proceed.wait(5)
+            return files()
+        cache.files = blocking_files
+        # requests don't wait for the scan, nor start another one
+        self.assertEqual(cache.get('0'), 'x')
+        walking.wait(5)
+        scanner = cache.scanner
+        cache.set('new', 'x')
+        self.failUnless(cache.start_scan() is None)
+        self.failUnless(cache.scanner is scanner)
+        self.assertEqual(cache.stats()['entries'], 1)
+        proceed.set()
+        scanner.join()
+        # entries written during the scan are kept
+        self.assertEqual(cache.stats()['entries'], 4)
+
+    def test_memcached(self):
+        from repoze.bitblt.cache import MemcachedCache
+        server = MemcachedStandIn()
+        try:
+            cache = MemcachedCache(server.address)
+            self._checkBackend(cache)
+            long_key = 'k' * 300
+            cache.set(long_key, 'value')
+            self.assertEqual(cache.get(long_key), 'value')
+            self.failUnless(cache.has(long_key))
+            self.failIf(long_key in server.data)
+            self.assertEqual(server.commands[-1], 'mg')
+        finally:
+            server.close()
+
+    def test_memcached_has_without_meta_commands(self):
+        from repoze.bitblt.cache import MemcachedCache
+        server = MemcachedStandIn()
+        try:
+            server.meta = False
+            cache = MemcachedCache(server.address)
+            cache.set('foo', 'bar')
+            self.failUnless(cache.has('foo'))
+            self.failIf(cache.has('baz'))
+            self.assertEqual(server.commands, ['set', 'mg', 'get', 'get'])
+        finally:
+            server.close()
+
+    def test_memcached_unavailable(self):
+        import socket
+        from repoze.bitblt.cache import MemcachedCache
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        address = '127.0.0.1:%d' % sock.getsockname()[1]
+        sock.close()
+        cache = MemcachedCache([address], timeout=0.5)
+        cache.set('foo', 'bar')
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.stats()['errors'], 2)
+
+    def test_make_cache(self):
+        from repoze.bitblt.cache import make_cache
+        from repoze.bitblt.cache import FileSystemCache
+        from repoze.bitblt.cache import MemoryCache
+        from repoze.bitblt.cache import MemcachedCache
+        self.assertEqual(make_cache(None), None)
+        cache = make_cache('/tmp', max_entries='10')
+        self.failUnless(isinstance(cache, FileSystemCache))
+        cache = make_cache(None, 'memory', max_entries='10', servers=None)
+        self.failUnless(isinstance(cache, MemoryCache))
+        self.assertEqual(cache.index.max_entries, 10)
+        cache = make_cache(None, 'memcached', servers='a:1 b:2')
+        self.failUnless(isinstance(cache, MemcachedCache))
+        self.assertEqual(cache.servers, [('a', 1), ('b', 2)])
+        self.assertEqual(make_cache(cache), cache)
+        self.assertRaises(ValueError, make_cache, None, 'bogus')
+
+    def test_paste_config(self):
+        from repoze.bitblt.processor import make_bitblt_middleware
+        from repoze.bitblt.cache import MemcachedCache
+        server = MemcachedStandIn()
+        try:
+            calls = []
+            def mock_app(environ, start_response):
+                calls.append(environ['PATH_INFO'])
+                response = webob.Response(
+                    jpeg_image_data, content_type='image/jpeg')
+                return response(environ, start_response)
+            middleware = make_bitblt_middleware(
+                mock_app, {}, secret='secret', cache_backend='memcached',
+                cache_servers=server.address, revalidate='never')
+            self.failUnless(isinstance(middleware.cache, MemcachedCache))
+            signature = transform.compute_signature(32, 32, 'secret')
+            url = 'bitblt-32x32-%s/foo.jpg' % signature
+            response = webob.Request.blank(url).get_response(middleware)
+            cached = webob.Request.blank(url).get_response(middleware)
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(cached.body, response.body)
+            self.assertEqual(len(server.data), 1)
+        finally:
+            server.close()
+
+class TestWarm(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dirs = []
+
+    def tearDown(self):
+        import shutil
+        for temp_dir in self._temp_dirs:
+            shutil.rmtree(temp_dir)
+
+    def _makeDir(self):
+        import tempfile
+        temp_dir = tempfile.mkdtemp(prefix='repoze.bitblt-tests-')
+        self._temp_dirs.append(temp_dir)
+        return temp_dir
+
+    def _makeSite(self):
+        import os
+        root = self._makeDir()
+        os.mkdir(os.path.join(root, 'images'))
+        f = open(os.path.join(root, 'images', 'foo.jpg'), 'wb')
+        f.write(jpeg_image_data)
+        f.close()
+        page = os.path.join(self._makeDir(), 'index.html')
+        f = open(page, 'w')
+        f.write('<html><body>'
+                '<img src="/images/foo.jpg" width="16" height="16" />'
+                '<img src="foo.jpg" width="16" height="16" />'
+                '<img src="http://host/images/foo.jpg" height="32" />'
+                '<img src="missing.jpg" width="16" />'
+                '<img src="/images/foo.jpg" /></body></html>')
+        f.close()
+        return root, page
+
+    def test_find_images(self):
+        from repoze.bitblt.warm import find_images
+        body = open(self._makeSite()[1]).read()
+        signature = transform.compute_signature('16', '16', 'secret')
+        self.assertEqual(find_images(body, 'secret', '/images/'), [
+            '/images/bitblt-16x16-%s/foo.jpg' % signature,
+            '/images/bitblt-Nonex32-%s/foo.jpg' % (
+                transform.compute_signature(None, '32', 'secret')),
+            '/images/bitblt-16xNone-%s/missing.jpg' % (
+                transform.compute_signature('16', None, 'secret'))])
+
+    def test_static_app(self):
+        from repoze.bitblt.warm import static_app
+        app = static_app(self._makeSite()[0])
+        response = webob.Request.blank('/images/foo.jpg').get_response(app)
+        self.assertEqual(response.content_type, 'image/jpeg')
+        self.assertEqual(response.body, jpeg_image_data)
+        for path in ('/images/bar.jpg', '/images', '/../tests.py'):
+            response = webob.Request.blank(path).get_response(app)
+            self.assertEqual(response.status_int, 404)
+
+    def test_main(self):
+        from repoze.bitblt.processor import ImageTransformationMiddleware
+        from repoze.bitblt.warm import main
+        root, page = self._makeSite()
+        cache = self._makeDir()
+        out = StringIO()
+        status = main(['--secret', 'secret', '--root', root, '--cache', cache,
+                       '--base', '/images/', '-o', 'quality=90', '-j', '1',
+                       page], out)
+        # the missing image is reported
+        self.assertEqual(status, 1)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.failUnless(lines[0].startswith('[1/3] 200 OK /images/bitblt-'))
+        self.failUnless(lines[2].startswith('[3/3] 404 Not Found'))
+        self.assertEqual(lines[3], '2 of 3 images generated.')
+        # the server finds the images in the cache
+        calls = []
+        def app(environ, start_response):
+            calls.append(environ['PATH_INFO'])
+            start_response('404 Not Found', [])
+            return []
+        middleware = ImageTransformationMiddleware(
+            app, secret='secret', cache=cache, quality='90',
+            revalidate='never')
+        signature = transform.compute_signature('16', '16', 'secret')
+        response = webob.Request.blank(
+            '/images/bitblt-16x16-%s/foo.jpg' % signature).get_response(
+            middleware)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(calls, [])
+
+    def test_warm_processes(self):
+        import os
+        from repoze.bitblt.warm import warm
+        root = self._makeSite()[0]
+        cache = self._makeDir()
+        signature = transform.compute_signature('16', '16', 'secret')
+        progress = []
+        failed = warm(['/images/bitblt-16x16-%s/foo.jpg' % signature],
+                      root, dict(secret='secret', cache=cache), workers=2,
+                      progress=lambda *args: progress.append(args))
+        self.assertEqual(failed, [])
+        self.assertEqual(len(progress), 1)
+        self.assertEqual(len([name for dirpath, dirnames, names
+                              in os.walk(cache) for name in names
+                              if not name.startswith('.')]), 1)
+
+
 # .ico image 10px wide, 5px tall
 ico_image_data = base64.decodestring("""\
 AAABAAEACgUAAAAAIAAEAQAAFgAAACgAAAAKAAAACgAAAAEAIAAAAAAAkAEAAAAAAAAAAAAAAAAA
@@ -1,5 +1,7 @@
+import codecs
 import re
 from StringIO import StringIO
+import threading
 import urlparse
 
 try:
@@ -15,12 +17,132 @@ re_img = re.compile(r'''<img'''
                         r'''|[\w:]*=(?:'[^']*'|"[^"]*"|[^<>"'\s]*)''' # or match but ignore most other tags
                     r'''))+\s*/?>''') # match whitespace at the end and the end tag
 
+# re_img gives each value of src, width and height two ways to match,
+# and tries all combinations of them on tags which don't match in the
+# end, which takes time exponential in the number of attributes.
+# re_img_short matches the tags re_img matches which have up to 8
+# attributes, which keeps this cheap, and just ``<img`` at other tags.
+re_img_short = re.compile(r'''<img(?:'''
+                          r'''(?:\s+(?:''' # whitespace at start of tag
+                              r'''src=["']?(?P<src>[^"'\s]*)["']?''' # find src=
+                              r'''|width=["']?(?P<width>\d*)(?:px)?["']?''' # or find width=
+                              r'''|height=["']?(?P<height>\d*)(?:px)?["']?''' # or find height=
+                              r'''|[\w:]*=(?:'[^']*'|"[^"]*"|[^<>"'\s]*)''' # or match but ignore most other tags
+                          r''')){1,8}\s*/?>)?''') # at most 8 attributes, then the end tag
+
+# re_img_tag matches the tags re_img_short leaves, in time linear in
+# their length. Its alternatives exclude each other, and the named
+# groups capture only values which re_img would capture. Unlike re_img,
+# unquoted values end at ``>`` and values may not be followed by stray
+# quotes. So for tags of more than 8 attributes, iter_image_tags
+# differs from re_img on such malformed markup: a tag with a stray
+# quote is skipped, and one with ``>`` in a ``src``, ``width`` or
+# ``height`` value ends there, also when the value is quoted, as
+# re_img_short then settles for the text before it.
+re_img_tag = re.compile(r"""
+    <img
+    (?:\s+(?:
+        src=(?:(?:"(?=[^"'\s]*")|'(?=[^"'\s]*')|(?!["']))
+                (?P<src>(?<=["'])[^"'\s]*|(?<!["'])[^<>"'\s]*)["']?
+            |'(?![^"'\s]*')[^']*'|"(?![^"'\s]*")[^"]*") # not captured
+      | width=(?:(?:"(?=\d*(?:px)?")|'(?=\d*(?:px)?')
+                |(?!["'])(?=\d*(?:px)?(?:\s|/?>)))
+                (?P<width>\d*)(?:px)?["']?
+            |'(?!\d*(?:px)?')[^']*'|"(?!\d*(?:px)?")[^"]*"
+            |(?!\d*(?:px)?(?:\s|/?>))[^<>"'\s]*) # e.g. percentages
+      | height=(?:(?:"(?=\d*(?:px)?")|'(?=\d*(?:px)?')
+                |(?!["'])(?=\d*(?:px)?(?:\s|/?>)))
+                (?P<height>\d*)(?:px)?["']?
+            |'(?!\d*(?:px)?')[^']*'|"(?!\d*(?:px)?")[^"]*"
+            |(?!\d*(?:px)?(?:\s|/?>))[^<>"'\s]*)
+      | (?!(?:src|width|height)=)[\w:]*=(?:"[^"]*"|'[^']*'|[^<>"'\s]*)
+    ))+\s*/?>
+    """, re.VERBOSE)
+
+# an image tag up to the ``>`` which closes it, whether or not it
+# matches re_img_tag
+re_img_end = re.compile(r"""<img(?:[^>"']|"[^"]*"|'[^']*')*>""")
+
+def iter_image_tags(body):
+    """Yield the matches of the image tags in ``body`` like
+    ``re_img.finditer``, but in time linear in the length of ``body``.
+    Tags are matched with ``re_img_short``; ``re_img_tag`` only looks
+    at the tags it leaves, such as tags with many attributes."""
+    index = 0
+    for mo in re_img_short.finditer(body):
+        start = mo.start()
+        if start < index:
+            # within a long tag
+            continue
+        if mo.end() - start == 4:
+            mo = re_img_tag.match(body, start)
+            if mo is None:
+                continue
+        yield mo
+        index = mo.end()
+
 def compute_signature(width, height, key):
     return sha1("%s:%s:%s" % (width, height, key)).hexdigest()
 
 def verify_signature(width, height, key, signature):
     return signature == compute_signature(width, height, key)
 
+class SignatureCache(object):
+    """Remember the signatures for ``key`` of up to ``max_entries``
+    (width, height) pairs. Pages tend to use few distinct image
+    sizes, so this saves computing a digest for most image tags and
+    image requests. The cache is simply emptied when it is full."""
+
+    def __init__(self, key, max_entries=1024):
+        self.key = key
+        self.max_entries = int(max_entries)
+        self.signatures = {}
+
+    def __call__(self, width, height):
+        signature = self.signatures.get((width, height))
+        if signature is None:
+            signature = compute_signature(width, height, self.key)
+            if len(self.signatures) >= self.max_entries:
+                self.signatures.clear()
+            self.signatures[(width, height)] = signature
+        return signature
+
+    def verify(self, width, height, signature):
+        return signature == self(width, height)
+
+class SizeRegistry(object):
+    """Remember up to ``max_sizes`` sizes, as ``(width, height)``
+    strings, at which each of up to ``max_paths`` images is shown.
+    Like ``SignatureCache``, it is simply emptied when it is full."""
+
+    def __init__(self, max_sizes, max_paths=10000):
+        self.max_sizes = int(max_sizes)
+        self.max_paths = int(max_paths)
+        self.sizes = {}
+        self.lock = threading.Lock()
+
+    def add(self, path, width, height):
+        self.lock.acquire()
+        try:
+            sizes = self.sizes.get(path)
+            if sizes is None:
+                if len(self.sizes) >= self.max_paths:
+                    self.sizes.clear()
+                sizes = self.sizes[path] = []
+            if (width, height) not in sizes:
+                if len(sizes) >= self.max_sizes:
+                    del sizes[0]
+                sizes.append((width, height))
+        finally:
+            self.lock.release()
+
+    def get(self, path):
+        self.lock.acquire()
+        try:
+            return list(self.sizes.get(path, ()))
+        finally:
+            self.lock.release()
+
 def parse_regex_match(mo, app_url=None):
     d = dict(src=None, height=None, width=None)
     d.update(mo.groupdict())
@@ -33,29 +155,115 @@ def parse_regex_match(mo, app_url=None):
             return None
     return src, height, width, scheme, netloc, path, params, query, fragment
 
-def rewrite_image_tags(body, key, app_url=None):
-    mos =  re_img.finditer(body)
+def has_rewritable_tags(body):
+    """Return whether ``body`` may contain image tags which
+    ``rewrite_image_tags`` would rewrite, i.e. an ``<img`` followed by
+    ``width=`` or ``height=`` before the next ``<img``. This is much
+    cheaper than matching ``re_img`` and never misses a tag, but it may
+    give false positives."""
+    start = body.find('<img')
+    while start != -1:
+        end = body.find('<img', start + 4)
+        stop = end == -1 and len(body) or end
+        if body.find('width=', start, stop) != -1 or \
+               body.find('height=', start, stop) != -1:
+            return True
+        start = end
+    return False
+
+def ascii_compatible(encoding):
+    """Return whether ``encoding`` encodes the markup which
+    ``has_rewritable_tags`` looks for as ASCII, so that it can be
+    applied to encoded documents."""
+    markup = u'<img width= height='
+    try:
+        return markup.encode(encoding) == markup.encode('ascii')
+    except (LookupError, UnicodeError):
+        return False
+
+def rewrite_image_tags(body, key, app_url=None, signatures=None,
+                       found=None):
+    """Rewrite the ``src`` of image tags in ``body`` which have a width
+    and/or height. ``signatures`` may be a ``SignatureCache`` for
+    ``key``. ``found`` is called with the original ``src``, width and
+    height of each rewritten tag."""
+    if not has_rewritable_tags(body):
+        return body
+    if signatures is None:
+        signatures = SignatureCache(key)
+    # iter_image_tags, inlined as this is the hot path
+    mos = re_img_short.finditer(body)
     index = 0
     new_body = []
     for mo in mos:
+        start, end = mo.span()
+        if start < index:
+            # within a long tag
+            continue
+        if end - start == 4:
+            mo = re_img_tag.match(body, start)
+            if mo is None:
+                continue
+            end = mo.end()
         # add section before current match to new body
-        new_body.append(body[index:mo.start()])
-        index = mo.end()
+        new_body.append(body[index:start])
+        index = end
         # check conditions in which we should skip this tag
         result = parse_regex_match(mo, app_url=app_url)
         if result is None:
             # nothing interesting here, carry on
-            new_body.append(body[mo.start():mo.end()])
+            new_body.append(body[start:end])
             continue
         src, height, width, scheme, netloc, path, params, query, fragment = result
         # calculate new src url
-        signature = compute_signature(width, height, key)
+        signature = signatures(width, height)
+        if found is not None:
+            found(src, width, height)
         parts = path.split('/')
         parts.insert(-1, 'bitblt-%sx%s-%s' % (width, height, signature))
         path = '/'.join(parts)
         src = urlparse.urlunparse((scheme, netloc, path, params, query, fragment))
         # add to new_body
-        new_body.extend([body[mo.start():mo.start('src')], src, body[mo.end('src'):mo.end()]])
+        new_body.extend([body[start:mo.start('src')], src, body[mo.end('src'):end]])
     # add section after last match to new body
     new_body.append(body[index:])
     return ''.join(new_body)
+
+def rewritable_length(body, max_pending=65536):
+    """Return the length of the part of ``body`` which can be rewritten
+    without knowing what follows it, i.e. up to an ``<img`` tag which
+    is not closed yet. Beyond ``max_pending`` held back characters,
+    the tag is given up on."""
+    length = len(body)
+    index = body.rfind('<', max(length - 3, 0))
+    if index != -1 and '<img'.startswith(body[index:]):
+        length = index
+    index = body.rfind('<img', 0, length)
+    if index != -1 and re_img_end.match(body, index) is None:
+        length = index
+    if len(body) - length > max_pending:
+        return len(body)
+    return length
+
+def rewrite_image_tags_iter(chunks, key, app_url=None, encoding='utf-8',
+                            signatures=None, found=None):
+    """Rewrite image tags in an iterable of encoded ``chunks`` and
+    yield encoded chunks as soon as they are rewritten. Tags which are
+    split across chunks are held back until they are complete."""
+    if signatures is None:
+        signatures = SignatureCache(key)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = u''
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        length = rewritable_length(pending)
+        if length:
+            yield rewrite_image_tags(
+                pending[:length], key, app_url=app_url,
+                signatures=signatures, found=found).encode(encoding)
+            pending = pending[length:]
+    pending += decoder.decode('', True)
+    if pending:
+        yield rewrite_image_tags(
+            pending, key, app_url=app_url,
+            signatures=signatures, found=found).encode(encoding)
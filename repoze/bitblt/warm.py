@@ -0,0 +1,180 @@
+""" Generate the scaled images on a set of pages ahead of time, so that
+they are already in the cache when the first visitors arrive.
+
+  bitblt-warm --secret SECRET --root IMAGES --cache CACHE PAGE...
+
+Each page is an HTML file or URL. Its image tags are rewritten as the
+middleware would, and every scaled image is requested from a
+middleware which serves the files below the image root."""
+
+import mimetypes
+import optparse
+import os
+import sys
+import urllib2
+import urlparse
+
+import webob
+
+from processor import ImageTransformationMiddleware
+from processor import re_bitblt
+from transform import iter_image_tags
+from transform import rewrite_image_tags
+
+def find_images(body, secret, base='/', app_url=None):
+    """Return the paths of the scaled images on the page ``body``,
+    resolving relative paths against ``base``."""
+    paths = []
+    seen = set()
+    for match in iter_image_tags(rewrite_image_tags(body, secret, app_url)):
+        src = match.group('src')
+        if not src or re_bitblt.search(src) is None:
+            continue
+        path = urlparse.urlparse(urlparse.urljoin(base, src))[2]
+        if path not in seen:
+            seen.add(path)
+            paths.append(path)
+    return paths
+
+def read_page(page, encoding='utf-8'):
+    """Return the contents of the HTML file or URL ``page``."""
+    if urlparse.urlparse(page)[0] in ('http', 'https', 'file'):
+        f = urllib2.urlopen(page)
+    else:
+        f = open(page, 'rb')
+    try:
+        return f.read().decode(encoding, 'replace')
+    finally:
+        f.close()
+
+def static_app(root):
+    """Return an application which serves the files below ``root``."""
+    root = os.path.abspath(root)
+    def app(environ, start_response):
+        path = os.path.normpath(os.path.join(
+            root, environ['PATH_INFO'].lstrip('/')))
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            response = webob.Response(status=404)
+        else:
+            content_type = mimetypes.guess_type(path)[0]
+            f = open(path, 'rb')
+            try:
+                response = webob.Response(
+                    f.read(), content_type=content_type or
+                    'application/octet-stream')
+            finally:
+                f.close()
+        return response(environ, start_response)
+    return app
+
+# the middleware of a worker process; see ``init``
+middleware = None
+
+def init(root, options):
+    global middleware
+    middleware = ImageTransformationMiddleware(static_app(root), **options)
+
+def generate(path, accept=None):
+    """Request the scaled image at ``path`` and return the path and
+    the status of the response."""
+    request = webob.Request.blank(path)
+    if accept:
+        request.environ['HTTP_ACCEPT'] = accept
+    try:
+        response = request.get_response(middleware)
+    except Exception:
+        return path, '500 %s' % sys.exc_info()[1]
+    return path, response.status
+
+def generate_task(task):
+    return generate(*task)
+
+def warm(paths, root, options, workers=None, accept=None, progress=None):
+    """Generate the scaled images at ``paths`` in ``workers`` processes
+    (one per CPU by default), calling ``progress`` with the number of
+    images done, the path and the status after each one. Return the
+    paths which failed, with their status."""
+    tasks = [(path, accept) for path in paths]
+    if workers == 1:
+        init(root, options)
+        results = (generate(*task) for task in tasks)
+        pool = None
+    else:
+        from multiprocessing import Pool
+        pool = Pool(workers, init, (root, options))
+        results = pool.imap_unordered(generate_task, tasks)
+    failed = []
+    try:
+        for done, (path, status) in enumerate(results):
+            if not status.startswith('200'):
+                failed.append((path, status))
+            if progress is not None:
+                progress(done + 1, path, status)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return failed
+
+def main(argv=None, out=sys.stderr):
+    parser = optparse.OptionParser(
+        usage='%prog [options] PAGE...',
+        description='Generate the scaled images on the pages (HTML files '
+        'or URLs) and store them in the cache.')
+    parser.add_option('--secret', help='the secret of the middleware')
+    parser.add_option('--root', help='the directory the images are '
+                      'served from')
+    parser.add_option('--cache', help='the cache of the middleware')
+    parser.add_option('--cache-backend', default=None,
+                      help='file (the default) or memcached')
+    parser.add_option('-o', '--option', action='append', default=[],
+                      metavar='NAME=VALUE',
+                      help='another middleware option, e.g. quality=90')
+    parser.add_option('--base', default='/', help='the URL path which '
+                      'relative image paths are resolved against')
+    parser.add_option('--accept', help='the Accept header to send, to '
+                      'generate images for output_formats')
+    parser.add_option('--encoding', default='utf-8',
+                      help='the encoding of the pages')
+    parser.add_option('-j', '--workers', type='int', default=None,
+                      help='the number of processes (one per CPU by '
+                      'default)')
+    parser.add_option('-q', '--quiet', action='store_true', default=False,
+                      help='do not report progress')
+    options, pages = parser.parse_args(argv)
+    if not pages:
+        parser.error('no pages given')
+    for name in ('secret', 'root', 'cache'):
+        if not getattr(options, name):
+            parser.error('--%s is required' % name)
+    if options.cache_backend == 'memory':
+        parser.error('the memory cache is not shared with the server')
+
+    config = dict(secret=options.secret, cache=options.cache,
+                  cache_backend=options.cache_backend)
+    for option in options.option:
+        name, sep, value = option.partition('=')
+        if not sep:
+            parser.error('option %r is not of the form NAME=VALUE' % option)
+        config[name.strip()] = value.strip()
+
+    paths = []
+    seen = set()
+    for page in pages:
+        body = read_page(page, options.encoding)
+        for path in find_images(body, options.secret, options.base):
+            if path not in seen:
+                seen.add(path)
+                paths.append(path)
+
+    def progress(done, path, status):
+        if not options.quiet:
+            out.write('[%d/%d] %s %s\n' % (done, len(paths), status, path))
+    failed = warm(paths, options.root, config, options.workers,
+                  options.accept, progress)
+    if not options.quiet:
+        out.write('%d of %d images generated.\n' % (
+            len(paths) - len(failed), len(paths)))
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
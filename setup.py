@@ -29,6 +29,8 @@ setup(name='repoze.bitblt',
         "Development Status :: 4 - Beta",
         "Intended Audience :: Developers",
         "Programming Language :: Python",
+        "Programming Language :: Python :: 2.6",
+        "Programming Language :: Python :: 2.7",
         "Topic :: Internet :: WWW/HTTP",
         "Topic :: Internet :: WWW/HTTP :: WSGI",
         "Topic :: Internet :: WWW/HTTP :: WSGI :: Application",
@@ -38,7 +40,7 @@ setup(name='repoze.bitblt',
       author_email="repoze-dev@lists.repoze.org",
       url="http://www.repoze.org",
       license="BSD-derived (http://www.repoze.org/LICENSE.txt)",
-      packages=find_packages(),
+      packages=find_packages(exclude=['benchmarks']),
       include_package_data=True,
       namespace_packages=['repoze'],
       zip_safe=False,
@@ -50,6 +52,9 @@ setup(name='repoze.bitblt',
       entry_points = """\
       [paste.filter_app_factory]
       bitblt = repoze.bitblt.processor:make_bitblt_middleware
+      [console_scripts]
+      bitblt-warm = repoze.bitblt.warm:main
+      bitblt-migrate-cache = repoze.bitblt.cache:migrate_main
       """
       )
 